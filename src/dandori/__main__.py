@@ -3,14 +3,15 @@ from __future__ import annotations
 import argparse
 import sys
 
-import ruamel.yaml
-from box import Box
-
 import dandori.log
-import dandori.run
+import dandori.startup
 
 
 def _parse_options(lines):
+    # imported after --profile-startup is enabled to be measured, box imports ruamel.yaml and toml anyway
+    import ruamel.yaml  # pylint: disable=import-outside-toplevel
+    from box import Box  # pylint: disable=import-outside-toplevel
+
     options = Box()
     yaml = ruamel.yaml.YAML(typ="safe")
     if lines:
@@ -29,24 +30,91 @@ def _parse_options(lines):
     return options
 
 
+COMMANDS = ("run", "serve", "bench")
+
+
 def main():
-    """entrypoint of dandori command"""
+    """entrypoint of dandori command
+
+    `dandori [run] ...` handles the event of GitHub Actions, `dandori serve ...` serves events as a daemon,
+    `dandori bench ...` measures handlers with stored events and recorded API responses
+    """
     sys.stdout.reconfigure(line_buffering=True)
-    args = _parse_args()
-    cpath = args.config_file
-    options = _parse_options(args.options)
-    runner = dandori.run.Runner(cpath, options=options)
-    runner.execute(args.invoke)
+    argv = sys.argv[1:]
+    command = argv.pop(0) if argv and argv[0] in COMMANDS else "run"
+    args = _parse_args(command, argv)
+    if args.profile_startup:
+        dandori.startup.enable()
+    try:
+        with dandori.startup.phase("import dandori.run"):
+            from dandori.run import Runner  # pylint: disable=import-outside-toplevel
+        cpath = args.config_file
+        with dandori.startup.phase("parse options"):
+            options = _parse_options(args.options)
+        runner = Runner(cpath, options=options)
+        if command == "serve":
+            from dandori.serve import serve  # pylint: disable=import-outside-toplevel
+
+            serve(
+                runner,
+                host=args.host,
+                port=args.port,
+                unix_socket=args.unix_socket,
+                workers=args.workers,
+                max_queue=args.max_queue,
+                dry_run=args.dry_run,
+            )
+        elif command == "bench":
+            from dandori.bench import bench  # pylint: disable=import-outside-toplevel
+
+            bench(
+                runner,
+                args.events,
+                args.cassette,
+                event_name=args.event_name,
+                iterations=args.iterations,
+                warmup=args.warmup,
+                record=args.record,
+                latency=args.latency / 1000,
+                jitter=args.jitter / 1000,
+                invoke_function=args.invoke,
+                json_path=args.json,
+            )
+        else:
+            runner.execute(args.invoke)
+    finally:
+        if dandori.startup.PROFILER is not None:
+            dandori.startup.PROFILER.stop()
+            print(dandori.startup.PROFILER.report(), file=sys.stderr)
 
 
-def _parse_args():
-    psr = argparse.ArgumentParser()
+def _parse_args(command: str, argv: list[str]):
+    psr = argparse.ArgumentParser(prog=f"dandori {command}" if command != "run" else "dandori")
     psr.add_argument("-v", "--verbose", default=0, action="count")
     psr.add_argument("-f", "--config-file", help="configuration file path (toml or yaml)")
-    psr.add_argument("-i", "--invoke", help="Invoke specific function manually")
     psr.add_argument("--github-token", help="github token")
     psr.add_argument("-o", "--options", action="append", help="optional arguments")
-    args = psr.parse_args()
+    psr.add_argument("--profile-startup", action="store_true", help="report time of startup phases and imports")
+    if command == "serve":
+        psr.add_argument("--host", default="127.0.0.1", help="address to listen")
+        psr.add_argument("--port", default=8765, type=int, help="port to listen")
+        psr.add_argument("--unix-socket", help="listen on the unix socket instead of TCP")
+        psr.add_argument("--workers", default=4, type=int, help="number of events handled at the same time")
+        psr.add_argument("--max-queue", default=100, type=int, help="max number of waiting events")
+        psr.add_argument("--dry-run", action="store_true", help="do not call GitHub API")
+    else:
+        psr.add_argument("-i", "--invoke", help="Invoke specific function manually")
+    if command == "bench":
+        psr.add_argument("events", nargs="+", help="event payload files (same as GITHUB_EVENT_PATH)")
+        psr.add_argument("-c", "--cassette", required=True, help="file of recorded GitHub API responses")
+        psr.add_argument("-e", "--event-name", help="event name, the file name without suffix by default")
+        psr.add_argument("-n", "--iterations", default=10, type=int, help="number of measured iterations")
+        psr.add_argument("--warmup", default=1, type=int, help="number of iterations before measurement")
+        psr.add_argument("--latency", default=0.0, type=float, help="milliseconds added to each API response")
+        psr.add_argument("--jitter", default=0.0, type=float, help="max random milliseconds added to latency")
+        psr.add_argument("--record", action="store_true", help="call GitHub API once and record the responses")
+        psr.add_argument("--json", help="write results to the file as JSON")
+    args = psr.parse_args(argv)
 
     # set log level
     dandori.log.set_level(
@@ -0,0 +1,211 @@
+from __future__ import annotations
+
+import dataclasses
+import json
+import pathlib
+import time
+import typing as T
+
+import dandori.cassette
+import dandori.log
+import dandori.transport
+from dandori import process, stats
+from dandori.gh import GitHub
+from dandori.run import Runner
+from dandori.serve import webhook_environ
+
+L = dandori.log.get_logger(__name__)
+
+PERCENTILES = (50, 90, 99)
+EVENT_ROW = "(event)"  # row of whole dispatch of an event
+
+
+@dataclasses.dataclass
+class Event:
+    name: str
+    payload: dict
+    path: pathlib.Path
+
+    @classmethod
+    def load(cls, path: pathlib.Path, name: T.Optional[str] = None) -> Event:
+        """Load event payload like GITHUB_EVENT_PATH. The event name is the file name without suffix by default"""
+        path = pathlib.Path(path)
+        with path.open(encoding="utf-8") as fi:
+            payload = json.load(fi)
+        return cls(name=name or path.stem, payload=payload, path=path)
+
+    def environ(self) -> dict[str, str]:
+        """GITHUB_* variables of the event"""
+        return {**webhook_environ(self.name, self.payload), "GITHUB_EVENT_PATH": str(self.path)}
+
+
+@dataclasses.dataclass
+class Row:
+    name: str
+    calls: int
+    percentiles: dict[int, float]  # percentile -> seconds
+    max: float
+    api_requests: float  # per iteration
+    commands: float  # per iteration
+    command_wall: float  # seconds per iteration
+    command_cpu: float  # seconds per iteration
+
+
+class Bench:
+    def __init__(
+        self,
+        runner: Runner,
+        events: list[Event],
+        cassette: pathlib.Path,
+        record: bool = False,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        invoke_function: T.Optional[str] = None,
+    ):
+        """Run handlers for stored events with recorded GitHub API responses
+
+        Args:
+            runner (Runner): runner of the configuration
+            events (list[Event]): events dispatched in each iteration
+            cassette (pathlib.Path): recorded responses
+            record (bool): call GitHub API and record responses to the cassette instead of replaying them
+            latency (float): seconds added to each replayed response
+            jitter (float): max random seconds added to latency
+            invoke_function (str): function called instead of handle_<event name>
+        """
+        self._runner = runner
+        self._events = events
+        self._invoke_function = invoke_function
+        if record:
+            self._cassette: T.Union[dandori.cassette.Recorder, dandori.cassette.Player] = dandori.cassette.Recorder(
+                cassette
+            )
+        else:
+            self._cassette = dandori.cassette.Player(cassette, latency=latency, jitter=jitter)
+        self._apis: dict[str, dandori.transport.Client] = {}  # repository -> client
+        self.errors = 0
+        self.iterations = 0
+
+    def run(self, iterations: int = 10, warmup: int = 1):
+        """Dispatch all events `iterations` times after `warmup` iterations which are not measured"""
+        self._runner.prepare()
+        with self._runner.activate():
+            for _ in range(warmup):
+                self._iterate()
+            self._reset()
+            for i in range(iterations):
+                L.verbose1("Iteration %d/%d", i + 1, iterations)
+                self._iterate()
+                self.iterations += 1
+
+    def rows(self) -> list[Row]:
+        """Measured results per handler, and of whole events"""
+        n = max(self.iterations, 1)
+        rows = []
+        for name in [EVENT_ROW] + sorted(x for x in self._runner.durations.handlers() if x != EVENT_ROW):
+            samples = self._runner.durations.get(name)
+            handler = None if name == EVENT_ROW else name  # an event row has totals of the event
+            usages = [usage for _, usage in process.USAGE.get(handler)]
+            rows.append(
+                Row(
+                    name=name,
+                    calls=len(samples),
+                    percentiles={q: stats.percentile(samples, q) for q in PERCENTILES},
+                    max=max(samples, default=0.0),
+                    api_requests=sum(x.stats.get(handler).get("requests", 0) for x in self._apis.values()) / n,
+                    commands=len(usages) / n,
+                    command_wall=sum(x.wall for x in usages) / n,
+                    command_cpu=sum(x.user + x.system for x in usages) / n,
+                )
+            )
+        return rows
+
+    def report(self) -> str:
+        """Table of results"""
+        header = ["handler", "calls", *(f"p{q} ms" for q in PERCENTILES), "max ms"]
+        header += ["api/it", "cmd/it", "cmd s/it", "cpu s/it"]
+        table = [header]
+        for row in self.rows():
+            table.append(
+                [row.name, str(row.calls)]
+                + [f"{row.percentiles[q] * 1000:.1f}" for q in PERCENTILES]
+                + [f"{row.max * 1000:.1f}", f"{row.api_requests:g}", f"{row.commands:g}"]
+                + [f"{row.command_wall:.2f}", f"{row.command_cpu:.2f}"]
+            )
+        widths = [max(len(x[i]) for x in table) for i in range(len(header))]
+        lines = [f"{self.iterations} iterations of {len(self._events)} events, {self.errors} errors"]
+        for cols in table:
+            cells = [x.ljust(w) if i == 0 else x.rjust(w) for i, (x, w) in enumerate(zip(cols, widths))]
+            lines.append("  ".join(cells))
+        return "\n".join(lines)
+
+    def to_dict(self) -> dict:
+        """Results as JSON serializable dict"""
+        return {
+            "iterations": self.iterations,
+            "events": [str(x.path) for x in self._events],
+            "errors": self.errors,
+            "handlers": [dataclasses.asdict(x) for x in self.rows()],
+        }
+
+    def _iterate(self):
+        for event in self._events:
+            if isinstance(self._cassette, dandori.cassette.Player):
+                self._cassette.rewind()
+            environ = event.environ()
+            api = self._api(environ["GITHUB_REPOSITORY"])
+            gh = GitHub(environ=environ, payload=event.payload, api=api, checkout=False)
+            with stats.handler_scope(EVENT_ROW):
+                started = time.perf_counter()
+                try:
+                    self._runner.dispatch(gh, self._invoke_function)
+                except Exception as e:  # pylint: disable=broad-except
+                    self.errors += 1
+                    L.warning("%s: %s: %s", event.path, type(e).__name__, e)
+                finally:
+                    self._runner.durations.add(time.perf_counter() - started)
+
+    def _api(self, repository: str) -> dandori.transport.Client:
+        if repository not in self._apis:
+            owner, _, name = repository.partition("/")
+            # no cache and throttling, every request reaches the cassette. Replayed retries do not wait
+            replay = isinstance(self._cassette, dandori.cassette.Player)
+            self._apis[repository] = dandori.transport.Client(
+                owner=owner,
+                repo=name,
+                cassette=self._cassette,
+                retry=dandori.transport.RetryPolicy(throttle_ratio=0.0, sleep=not replay),
+            )
+        return self._apis[repository]
+
+    def _reset(self):
+        self._runner.durations.reset()
+        process.USAGE.reset()
+        for api in self._apis.values():
+            api.stats.reset()
+        self.errors = 0
+
+
+def bench(
+    runner: Runner,
+    event_paths: list[str],
+    cassette: str,
+    event_name: T.Optional[str] = None,
+    iterations: int = 10,
+    warmup: int = 1,
+    record: bool = False,
+    latency: float = 0.0,
+    jitter: float = 0.0,
+    invoke_function: T.Optional[str] = None,
+    json_path: T.Optional[str] = None,
+):
+    """Benchmark handlers with stored events and print the results"""
+    events = [Event.load(pathlib.Path(x), event_name) for x in event_paths]
+    if record:
+        iterations, warmup = 1, 0  # record each request once
+    b = Bench(runner, events, pathlib.Path(cassette), record, latency, jitter, invoke_function)
+    b.run(iterations=iterations, warmup=warmup)
+    print(b.report())
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as fo:
+            json.dump(b.to_dict(), fo, indent=2)
@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import contextlib
+import fcntl
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+import typing as T
+
+import dandori.log
+
+L = dandori.log.get_logger(__name__)
+
+_SHARED: dict[pathlib.Path, DirectoryCache] = {}
+_SHARED_LOCK = threading.Lock()
+
+
+@contextlib.contextmanager
+def file_lock(path: pathlib.Path, shared=False):
+    """flock based lock between processes (and threads)"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("a") as fo:
+        fcntl.flock(fo, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fo, fcntl.LOCK_UN)
+
+
+def tree_size(path: pathlib.Path) -> int:
+    """Total size of files under the path in bytes"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def atomic_write(path: pathlib.Path, data: bytes):
+    """Write data into a temporary file and rename it, readers never see partial content"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=f".{path.name}.", dir=path.parent)
+    try:
+        with os.fdopen(fd, "wb") as fo:
+            fo.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
+        raise
+
+
+def prune_files(root: pathlib.Path, max_bytes: int):
+    """Remove least recently modified files under root until the total size fits in max_bytes"""
+    if not max_bytes or not root.is_dir():
+        return
+    files = []
+    for path in root.rglob("*"):
+        try:
+            if path.is_file():
+                st = path.stat()
+                files.append((st.st_mtime, st.st_size, path))
+        except OSError:
+            continue
+    total = sum(x[1] for x in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        with contextlib.suppress(OSError):
+            path.unlink()
+            total -= size
+
+
+def shared(root: pathlib.Path, max_bytes: int = 0) -> DirectoryCache:
+    """Return DirectoryCache of the root shared in this process"""
+    with _SHARED_LOCK:
+        if root not in _SHARED:
+            _SHARED[root] = DirectoryCache(root, max_bytes)
+        return _SHARED[root]
+
+
+class DirectoryCache:
+    """Directory entries shared between processes, built once and evicted in LRU order
+
+    An entry `<root>/<key>` has two sibling files. `<key>.lock` is locked exclusively while building and
+    shared while using, `<key>.ready` is created after the build finished and its mtime is the last used time.
+    Keys of a cache have the same number of `/` separated parts, e.g. `org/repo/sha`.
+    """
+
+    def __init__(self, root: pathlib.Path, max_bytes: int = 0):
+        """max_bytes=0 means unlimited"""
+        self.root = root
+        self.max_bytes = max_bytes
+        self._held: dict[str, T.IO] = {}
+        self._depths: set[int] = set()  # number of key parts, where `.ready` markers are
+        self._lock = threading.Lock()
+
+    def get(self, key: str, build: T.Callable[[pathlib.Path], None]) -> pathlib.Path:
+        """Return the entry directory of the key, `build(path)` fills it if it does not exist yet
+
+        The entry stays locked (shared) until this process exits, so other processes never evict it in use.
+        """
+        entry = self.root.joinpath(key)
+        lock_path, ready = self._sidecars(entry)
+        with self._lock:
+            held = key in self._held
+            self._depths.add(len(pathlib.PurePosixPath(key).parts))
+        if not held:
+            lock_path.parent.mkdir(parents=True, exist_ok=True)
+            fo = lock_path.open("a")
+            try:
+                fcntl.flock(fo, fcntl.LOCK_SH)
+                if not ready.exists():
+                    fcntl.flock(fo, fcntl.LOCK_EX)
+                    if not ready.exists():
+                        self._build(entry, ready, build)
+                    fcntl.flock(fo, fcntl.LOCK_SH)
+            except BaseException:
+                fo.close()
+                raise
+            with self._lock:
+                if key in self._held:
+                    fo.close()
+                else:
+                    self._held[key] = fo
+        L.verbose1("Use cache: %s", entry)
+        ready.touch()
+        self.evict()
+        return entry
+
+    def evict(self):
+        """Remove least recently used entries until the total size fits in max_bytes"""
+        if not self.max_bytes or not self.root.is_dir():
+            return
+        entries = []
+        with self._lock:
+            patterns = ["/".join(["*"] * depth) + ".ready" for depth in sorted(self._depths)]
+        # markers are listed at the depth of keys, files inside entries (e.g. a cloned repository) are not walked
+        for ready in (x for pattern in patterns for x in self.root.glob(pattern)):
+            try:
+                entries.append((ready.stat().st_mtime, int(ready.read_text() or 0), ready.with_suffix("")))
+            except (OSError, ValueError):
+                continue
+        total = sum(x[1] for x in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if self._remove(entry):
+                total -= size
+
+    def _build(self, entry: pathlib.Path, ready: pathlib.Path, build: T.Callable[[pathlib.Path], None]):
+        if entry.exists():  # incomplete build of another process
+            shutil.rmtree(entry)
+        entry.mkdir(parents=True)
+        L.verbose2("Build cache: %s", entry)
+        try:
+            build(entry)
+        except BaseException:
+            shutil.rmtree(entry, ignore_errors=True)
+            raise
+        ready.write_text(str(tree_size(entry)))
+
+    def _remove(self, entry: pathlib.Path) -> bool:
+        lock_path, ready = self._sidecars(entry)
+        with lock_path.open("a") as fo:
+            try:
+                fcntl.flock(fo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False  # in use
+            try:
+                L.verbose2("Evict cache: %s", entry)
+                with contextlib.suppress(FileNotFoundError):
+                    ready.unlink()
+                shutil.rmtree(entry, ignore_errors=True)
+            finally:
+                fcntl.flock(fo, fcntl.LOCK_UN)
+        return True
+
+    def _sidecars(self, entry: pathlib.Path) -> tuple[pathlib.Path, pathlib.Path]:
+        return entry.with_name(entry.name + ".lock"), entry.with_name(entry.name + ".ready")
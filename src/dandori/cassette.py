@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import base64
+import collections
+import hashlib
+import io
+import json
+import pathlib
+import random
+import threading
+import time
+import typing as T
+import urllib.error
+
+import dandori.exception
+import dandori.log
+
+L = dandori.log.get_logger(__name__)
+
+# Called by Recorder/Player to send a request for real: () -> (status, headers, content)
+Send = T.Callable[[], T.Tuple[int, T.Mapping[str, str], bytes]]
+
+
+class NotRecorded(dandori.exception.DandoriError):
+    """Request is not found in the cassette"""
+
+
+def _body_hash(data: T.Optional[bytes]) -> T.Optional[str]:
+    return None if data is None else hashlib.sha256(data).hexdigest()
+
+
+def _encode(content: bytes) -> dict[str, str]:
+    try:
+        return {"content": content.decode("utf-8")}
+    except UnicodeDecodeError:
+        return {"content_b64": base64.b64encode(content).decode("ascii")}
+
+
+def _decode(entry: dict) -> bytes:
+    if "content_b64" in entry:
+        return base64.b64decode(entry["content_b64"])
+    return entry.get("content", "").encode("utf-8")
+
+
+class Recorder:
+    def __init__(self, path: pathlib.Path):
+        """Append GitHub API interactions to a cassette (JSON lines file)"""
+        self.path = pathlib.Path(path)
+        self._lock = threading.Lock()
+
+    def send(self, verb: str, url: str, data: T.Optional[bytes], send: Send):
+        """Send the request and record its response, including error responses"""
+        try:
+            status, headers, content = send()
+        except urllib.error.HTTPError as e:
+            content = e.read()
+            self._record(verb, url, data, e.code, dict(e.headers or {}), content)
+            raise urllib.error.HTTPError(e.url, e.code, e.reason, e.headers, io.BytesIO(content)) from None
+        self._record(verb, url, data, status, dict(headers), content)
+        return status, headers, content
+
+    def _record(self, verb: str, url: str, data: T.Optional[bytes], status: int, headers: dict, content: bytes):
+        entry = {"verb": verb, "url": url, "body": _body_hash(data), "status": status, "headers": headers}
+        line = json.dumps({**entry, **_encode(content)}) + "\n"
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open("a", encoding="utf-8") as fo:
+                fo.write(line)
+
+
+class Player:
+    def __init__(self, path: pathlib.Path, latency: float = 0.0, jitter: float = 0.0):
+        """Serve recorded responses instead of calling GitHub API
+
+        Requests are matched by verb, url and request body, or by verb and url if no recorded body matches.
+        Repeated requests get recorded responses in order, the last one is repeated after all are used.
+
+        Args:
+            path (pathlib.Path): cassette written by Recorder
+            latency (float): seconds to wait before each response
+            jitter (float): max random seconds added to latency
+        """
+        self.path = pathlib.Path(path)
+        self.latency = latency
+        self.jitter = jitter
+        self._entries: dict[tuple, list[dict]] = collections.defaultdict(list)
+        self._cursors: collections.Counter = collections.Counter()
+        self._lock = threading.Lock()
+        count = 0
+        with self.path.open(encoding="utf-8") as fi:
+            for line in fi:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._entries[(entry["verb"], entry["url"], entry["body"])].append(entry)
+                    self._entries[(entry["verb"], entry["url"])].append(entry)
+                    count += 1
+        L.verbose1("Loaded %d recorded responses from %s", count, path)
+
+    def rewind(self):
+        """Serve recorded responses from the first again, e.g. for the next iteration of the event"""
+        with self._lock:
+            self._cursors.clear()
+
+    def send(self, verb: str, url: str, data: T.Optional[bytes], send: Send):  # pylint: disable=unused-argument
+        """Return the recorded response, raise HTTPError if it is an error response"""
+        wait = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if wait > 0:
+            time.sleep(wait)
+        entry = self._next((verb, url, _body_hash(data))) or self._next((verb, url))
+        if entry is None:
+            raise NotRecorded(f"{verb} {url} is not recorded in {self.path}")
+        content = _decode(entry)
+        if entry["status"] >= 400:
+            raise urllib.error.HTTPError(url, entry["status"], "recorded error", entry["headers"], io.BytesIO(content))
+        return entry["status"], entry["headers"], content
+
+    def _next(self, key: tuple) -> T.Optional[dict]:
+        entries = self._entries.get(key)
+        if not entries:
+            return None
+        with self._lock:
+            index = min(self._cursors[key], len(entries) - 1)
+            self._cursors[key] += 1
+        return entries[index]
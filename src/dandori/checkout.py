@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import dataclasses
+import os
+import typing as T
+
+import dandori.exception
+import dandori.git
+import dandori.log
+
+L = dandori.log.get_logger(__name__)
+
+STRATEGIES = ("full", "shallow", "partial", "sparse", "skip")
+MERGE_REF = "refs/remotes/origin/merge_commit"
+SPARSE_GIT_VERSION = (2, 35)  # `git sparse-checkout set --no-cone`
+
+
+@dataclasses.dataclass
+class Strategy:
+    name: str = "full"  # one of STRATEGIES
+    depth: T.Optional[int] = None  # fetch depth, None fetches all history (shallow: 1 by default)
+    paths: tuple[str, ...] = ()  # paths checked out by sparse strategy
+
+    def __post_init__(self):
+        """Validate arguments"""
+        if self.name not in STRATEGIES:
+            raise ValueError(f"checkout strategy must be one of {STRATEGIES}: {self.name}")
+        if self.name == "shallow" and self.depth is None:
+            self.depth = 1
+        if self.depth is not None and self.depth < 1:
+            raise ValueError(f"checkout depth must be positive: {self.depth}")
+        if self.name == "sparse" and not self.paths:
+            raise ValueError("sparse checkout needs at least one path")
+
+    @classmethod
+    def parse(cls, spec: str) -> Strategy:
+        """Parse `name[:arg]`: `shallow:<depth>` or `sparse:<path>,<path>,...`"""
+        name, _, arg = spec.strip().partition(":")
+        if name == "shallow":
+            return cls(name, depth=int(arg) if arg else None)
+        elif name == "sparse":
+            return cls(name, depth=1, paths=tuple(x.strip() for x in arg.split(",") if x.strip()))
+        elif arg:
+            raise ValueError(f"checkout strategy {name} takes no argument: {spec}")
+        return cls(name)
+
+    def fetch_args(self) -> list[str]:
+        """Options of git fetch"""
+        args = []
+        if self.depth is not None:
+            args.append(f"--depth={self.depth}")
+        if self.name in ("partial", "sparse"):
+            args.append("--filter=blob:none")
+        return args
+
+
+def select(spec: str, comment: str = "") -> Strategy:
+    """Select strategy for the comment from spec
+
+    spec is `;` separated rules. A rule is `<strategy>` (default) or `<comment prefix>=<strategy>`,
+    e.g. `shallow;/release=skip;/lint=sparse:src,docs`. The longest matching prefix wins.
+    """
+    default = Strategy()
+    best: T.Optional[tuple[str, Strategy]] = None
+    comment = comment.lstrip()
+    for rule in spec.split(";"):
+        if not rule.strip():
+            continue
+        prefix, sep, strategy = rule.rpartition("=")
+        if not sep:
+            default = Strategy.parse(strategy)
+        elif comment.startswith(prefix.strip()) and (best is None or len(prefix.strip()) > len(best[0])):
+            best = (prefix.strip(), Strategy.parse(strategy))
+    return default if best is None else best[1]
+
+
+def from_env(comment: str = "") -> Strategy:
+    """Strategy configured by DANDORI_CHECKOUT"""
+    return select(os.environ.get("DANDORI_CHECKOUT", ""), comment)
+
+
+def checkout(ops, ref: str, strategy: Strategy):
+    """Fetch ref from origin and check it out by the strategy
+
+    Args:
+        ops: dandori.ops.Operation
+        ref (str): commit sha
+        strategy (Strategy): how to fetch and check out
+    """
+    if strategy.name == "skip":
+        L.verbose1("Skip checkout of %s", ref)
+        return
+    if strategy.name == "sparse" and dandori.git.version() < SPARSE_GIT_VERSION:
+        found = ".".join(str(x) for x in dandori.git.version())
+        required = ".".join(str(x) for x in SPARSE_GIT_VERSION)
+        raise dandori.exception.DandoriError(f"sparse checkout needs git >= {required}, found {found}")
+    ops.run(["git", "fetch", *strategy.fetch_args(), "origin", f"+{ref}:{MERGE_REF}"])
+    if strategy.name == "sparse":
+        ops.run(["git", "sparse-checkout", "set", "--no-cone", *strategy.paths])
+    elif _is_sparse(ops):
+        ops.run(["git", "sparse-checkout", "disable"])  # checked out sparsely before, e.g. by DANDORI_CHECKOUT
+    ops.run(["git", "checkout", "--force", "-B", "merge_commit", MERGE_REF])
+
+
+def _is_sparse(ops) -> bool:
+    r = ops.run(["git", "config", "--bool", "core.sparseCheckout"], echo=False, check=False)
+    return r.returncode == 0 and r.stdout.strip() == "true"
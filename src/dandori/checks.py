@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import contextvars
+import threading
+import time
+import typing as T
+
+import dandori.log
+
+L = dandori.log.get_logger(__name__)
+
+MAX_ANNOTATIONS = 50  # GitHub accepts 50 annotations per request
+ANNOTATION_LEVELS = ("notice", "warning", "failure")
+CONCLUSION_ORDER = ("success", "neutral", "skipped", "cancelled", "failure")  # worse conclusion later
+
+_CURRENT: contextvars.ContextVar[T.Optional[T.Union[CheckRun, SubCheck]]] = contextvars.ContextVar(
+    "dandori_check", default=None
+)
+
+
+def current() -> T.Optional[T.Union[CheckRun, SubCheck]]:
+    """Check run of the running handler"""
+    return _CURRENT.get()
+
+
+def set_current(check: T.Optional[T.Union[CheckRun, SubCheck]]) -> contextvars.Token:
+    """Set check run of the running handler"""
+    return _CURRENT.set(check)
+
+
+def reset_current(token: contextvars.Token):
+    """Restore previous check run"""
+    _CURRENT.reset(token)
+
+
+def annotation(
+    path: str, start_line: int, message: str, end_line: T.Optional[int] = None, level: str = "notice", **kwargs
+):
+    """Build annotation object of Checks API"""
+    if level not in ANNOTATION_LEVELS:
+        raise ValueError(f"annotation level must be one of {ANNOTATION_LEVELS}: {level}")
+    return dict(
+        path=path,
+        start_line=start_line,
+        end_line=start_line if end_line is None else end_line,
+        annotation_level=level,
+        message=message,
+        **kwargs,
+    )
+
+
+class CheckRun:
+    def __init__(self, api, name: str, sha: str, defer: float = 0.0, min_interval: float = 5.0):
+        """Check run which buffers output and annotations
+
+        Args:
+            api: GhApi client
+            name (str): check name
+            sha (str): head sha
+            defer (float): create the check run only after this seconds (or when finished), 0 creates it at start
+            min_interval (float): minimum seconds between updates while running
+        """
+        self._api = api
+        self.name = name
+        self.sha = sha
+        self._defer = defer
+        self._min_interval = min_interval
+        self._id = None
+        self._finished = False
+        self._timer: T.Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+        self._annotations: list[dict] = []  # not sent yet
+        self._output: dict[str, str] = {"title": name, "summary": ""}
+        self._output_changed = False
+        self._last_update = 0.0
+
+    def start(self):
+        """Create in_progress check run now or after defer seconds"""
+        if self._defer > 0:
+            self._timer = threading.Timer(self._defer, contextvars.copy_context().run, args=(self._create,))
+            self._timer.daemon = True
+            self._timer.start()
+        else:
+            self._create()
+
+    def annotate(
+        self, path: str, start_line: int, message: str, end_line: T.Optional[int] = None, level="notice", **kwargs
+    ):
+        """Add an annotation. Annotations are sent in batches"""
+        with self._lock:
+            self._annotations.append(annotation(path, start_line, message, end_line, level, **kwargs))
+        self.flush()
+
+    def set_output(self, title: T.Optional[str] = None, summary: T.Optional[str] = None, text: T.Optional[str] = None):
+        """Set output of the check run"""
+        with self._lock:
+            for key, value in (("title", title), ("summary", summary), ("text", text)):
+                if value is not None:
+                    self._output[key] = value
+            self._output_changed = True
+        self.flush()
+
+    def append_summary(self, line: str):
+        """Append a line to the summary"""
+        with self._lock:
+            self._output["summary"] = "\n".join(x for x in (self._output["summary"], line) if x)
+            self._output_changed = True
+
+    def flush(self, force: bool = False):
+        """Send pending output and annotations, at most once in min_interval unless force"""
+        with self._lock:
+            if self._id is None or self._finished:
+                return
+            if not force and time.monotonic() - self._last_update < self._min_interval:
+                return
+            self._send_pending()
+
+    def finish(self, conclusion: str):
+        """Complete the check run. A check run not created yet is created as completed by one request"""
+        if self._timer is not None:
+            self._timer.cancel()
+        with self._lock:
+            self._finished = True
+            if self._id is None:
+                batch, self._annotations = self._annotations[:MAX_ANNOTATIONS], self._annotations[MAX_ANNOTATIONS:]
+                check = self._api.checks.create(
+                    name=self.name,
+                    head_sha=self.sha,
+                    status="completed",
+                    conclusion=conclusion,
+                    **self._output_kwargs(batch),
+                )
+                self._id = check.id
+                self._output_changed = False
+                self._send_pending()
+            else:
+                self._send_pending(last=dict(status="completed", conclusion=conclusion))
+
+    def _create(self):
+        with self._lock:
+            if self._id is not None or self._finished:
+                return
+            batch, self._annotations = self._annotations[:MAX_ANNOTATIONS], self._annotations[MAX_ANNOTATIONS:]
+            check = self._api.checks.create(
+                name=self.name, head_sha=self.sha, status="in_progress", **self._output_kwargs(batch)
+            )
+            self._id = check.id
+            self._output_changed = False
+            self._last_update = time.monotonic()
+
+    def _send_pending(self, last: T.Optional[dict] = None):
+        """Send annotations by batches. `last` is sent with the last batch"""
+        while self._annotations or self._output_changed or last:
+            batch, self._annotations = self._annotations[:MAX_ANNOTATIONS], self._annotations[MAX_ANNOTATIONS:]
+            kwargs = {**self._output_kwargs(batch), **({} if self._annotations else (last or {}))}
+            if kwargs:
+                self._api.checks.update(check_run_id=self._id, name=self.name, **kwargs)
+            self._output_changed = False
+            if not self._annotations:
+                last = None
+        self._last_update = time.monotonic()
+
+    def _output_kwargs(self, batch: list[dict]) -> dict:
+        """`output` parameter, omitted until there is content to report"""
+        if not batch and not self._output["summary"] and not self._output.get("text"):
+            return {}
+        output: dict = {**self._output, "annotations": batch}
+        if not output["summary"]:
+            output["summary"] = output["title"]  # summary is required in output
+        return {"output": output}
+
+
+class Umbrella:
+    def __init__(self, run: CheckRun):
+        """One check run which contains results of several checks"""
+        self.run = run
+        self.conclusion: T.Optional[str] = None
+        self._lock = threading.Lock()
+
+    def report(self, name: str, conclusion: str):
+        """Record conclusion of a part as a line of the summary"""
+        with self._lock:
+            self.conclusion = worse(self.conclusion, conclusion)
+        self.run.append_summary(f"- {name}: {conclusion}")
+        self.run.flush()
+
+
+class SubCheck:
+    def __init__(self, umbrella: CheckRun, name: str):
+        """A part of umbrella check run, reported as a line of its summary"""
+        self._umbrella = umbrella
+        self.name = name
+
+    def annotate(
+        self, path: str, start_line: int, message: str, end_line: T.Optional[int] = None, level="notice", **kwargs
+    ):
+        """Add an annotation to the umbrella check run"""
+        kwargs.setdefault("title", self.name)
+        self._umbrella.annotate(path, start_line, message, end_line, level, **kwargs)
+
+    def set_output(self, title: T.Optional[str] = None, summary: T.Optional[str] = None, text: T.Optional[str] = None):
+        """Add output as lines of umbrella summary"""
+        for value in (title, summary, text):
+            if value:
+                self._umbrella.append_summary(f"{self.name}: {value}")
+        self._umbrella.flush()
+
+
+def worse(a: T.Optional[str], b: str) -> str:
+    """Return worse conclusion"""
+    if a is None:
+        return b
+    return max(a, b, key=CONCLUSION_ORDER.index)
@@ -6,19 +6,41 @@ import pathlib
 import pprint
 import re
 import shutil
+import sys
+import threading
+import typing as T
 
 from box import Box
 
 import dandori.log
-from dandori import env, exception, git, ops
+from dandori import cache, env, exception, git, index, ops
 
 L = dandori.log.get_logger(__name__)
 
+DEPLOY_MODES = ("copy", "direct")
+
+_DIRECT_SOURCES: dict[str, pathlib.Path] = {}
+_SYS_PATH_LOCK = threading.Lock()
+
+
+def direct_source(name: str) -> T.Optional[pathlib.Path]:
+    """source path of handler `name` deployed with direct mode"""
+    return _DIRECT_SOURCES.get(name)
+
 
 class HandlerLoader:
-    def __init__(self, name: str):
-        """Handler loader for local path"""
+    def __init__(self, name: str, deploy_mode: str = "copy"):
+        """Handler loader for local path
+
+        Args:
+            name (str): module name
+            deploy_mode (str): "copy" copies files into temporal package directory,
+                "direct" imports files from the source path without copying
+        """
+        if deploy_mode not in DEPLOY_MODES:
+            raise ValueError(f"Unknown deploy_mode: {deploy_mode}")
         self._module_name = name
+        self._deploy_mode = deploy_mode
 
     @property
     def module_name(self):
@@ -29,6 +51,21 @@ class HandlerLoader:
         """load module"""
         return importlib.import_module(f"dandori.handlers.{self._module_name}")
 
+    def place_package(self, path):
+        """Make the package importable as dandori.handlers.{module_name} by deploy mode"""
+        if self._deploy_mode == "direct":
+            self.link_package(path)
+        else:
+            self.copy_package(path)
+
+    def link_package(self, path):
+        """Register path as the source of the package, HandlerFinder resolves it directly"""
+        path = pathlib.Path(path)
+        if not path.exists():
+            raise ValueError(f"{path} does not exist")
+        _DIRECT_SOURCES[self.module_name] = path.resolve()
+        L.debug("use %s directly for %s", path, self.module_name)
+
     def copy_package(self, path):
         """Place it to temporal package directory"""
         rootdir = env.tempdir().joinpath("handlers")
@@ -52,16 +89,24 @@ class HandlerLoader:
         """Retrieve package files and place it to temporal package directory"""
         raise NotImplementedError()
 
+    def source_path(self) -> pathlib.Path:
+        """Path of package files before deploy"""
+        raise NotImplementedError()
+
 
 class LocalHandlerLoader(HandlerLoader):
-    def __init__(self, name: str, path: pathlib.Path):
+    def __init__(self, name: str, path: pathlib.Path, deploy_mode: str = "copy"):
         """Handler loader for local path"""
-        super().__init__(name)
+        super().__init__(name, deploy_mode)
         self._path = path
 
     def deploy(self):
         """Retrieve package files and place it to temporal package directory"""
-        super().copy_package(self._path)
+        self.place_package(self._path)
+
+    def source_path(self) -> pathlib.Path:
+        """Local path"""
+        return pathlib.Path(self._path)
 
 
 class GitHandlerLoader(HandlerLoader):
@@ -74,14 +119,16 @@ class GitHandlerLoader(HandlerLoader):
         protocol: str = "ssh",
         revision: str = "",
         path: str = "",
+        deploy_mode: str = "copy",
     ):
         """Handler loader for git url"""
-        super().__init__(name)
+        super().__init__(name, deploy_mode)
         self._org = org
         self._repo = repo
         self._protocol = protocol
         self._revision = revision
         self._path = path
+        self._source: T.Optional[pathlib.Path] = None
 
     @property
     def url(self):
@@ -93,60 +140,100 @@ class GitHandlerLoader(HandlerLoader):
 
     def deploy(self):
         """Retrieve package files and place it to temporal package directory"""
-        cloned_path = self._clone()
-        super().copy_package(cloned_path)
+        self.place_package(self.source_path())
+
+    def source_path(self) -> pathlib.Path:
+        """Path in the repository cache, cloned at first call"""
+        if self._source is None:
+            self._source = self._clone()
+        return self._source
 
     def _clone(self) -> pathlib.Path:
-        """Clone this repo into dst"""
-        op = ops.Operation()
-        if env.is_local():
-            root = env.tempdir().joinpath(self._org, self._repo, self._revision)
-        else:
-            # remote job do not clone repo multiple times
-            root = env.cachedir().joinpath(self._org, self._repo, self._revision)
-        if root.is_dir():
-            L.verbose1("Use repository cache: %s", root)
-            if dandori.log.get_levelname() == "DEBUG":
-                ops.Operation().run(["ls", "-alh", str(root)])
-        else:
-            root.mkdir(parents=True, exist_ok=True)
-            cwd = str(root)
-            L.verbose2("git clone: url=%s, revision=%s, path=%s", self.url, self._revision, self._path)
-            op.run(["git", "init"], cwd=cwd, echo=False)
-            op.run(["git", "remote", "add", "origin", self.url], cwd=cwd, echo=False)
-            rev = self._revision
-            if not rev:
-                r = op.run(["git", "remote", "show", "origin"], cwd=cwd, echo=False)
-                mo = re.search(r"^\s+HEAD branch: (.+)$", r.stdout.decode("utf-8"), re.M)
-                if mo:
-                    rev = mo[1].strip()
-                else:
-                    rev = "main"
-                L.verbose2("Revision automatically set: %s", rev)
-            op.run(["git", "fetch", "--depth", "1", "origin", rev], cwd=cwd, echo=False)
-            op.run(["git", "-c", "advice.detachedHead=false", "checkout", "FETCH_HEAD"], cwd=cwd, echo=False)
+        """Clone this repo into the repository cache keyed by commit sha"""
+        sha = self._resolve_revision()
+        root = _repository_cache().get(f"{self._org}/{self._repo}/{sha}", lambda path: self._fetch(path, sha))
+        if dandori.log.get_levelname() == "DEBUG":
+            ops.Operation().run(["ls", "-alh", str(root)])
         if self._path:
             return root.joinpath(self._path)
         else:
             return root
 
+    def _resolve_revision(self) -> str:
+        """Resolve revision (branch, tag, sha or empty for default branch) into a commit sha by one ls-remote"""
+        if re.fullmatch(r"[0-9a-f]{40}", self._revision):
+            return self._revision
+        rev = self._revision or "HEAD"
+        refs = {ref: sha for sha, ref in git.ls_remote(self.url, rev, f"{rev}^{{}}")}
+        for ref in (rev, f"refs/heads/{rev}", f"refs/tags/{rev}^{{}}", f"refs/tags/{rev}"):
+            if ref in refs:
+                L.verbose2("Revision resolved: %s -> %s", rev, refs[ref])
+                return refs[ref]
+        raise exception.DandoriError(f"Revision not found in {self.url}: {rev}")
+
+    def _fetch(self, root: pathlib.Path, sha: str):
+        op = ops.Operation()
+        cwd = str(root)
+        L.verbose2("git clone: url=%s, revision=%s, sha=%s", self.url, self._revision, sha)
+        op.run(["git", "init"], cwd=cwd, echo=False)
+        op.run(["git", "remote", "add", "origin", self.url], cwd=cwd, echo=False)
+        op.run(["git", "fetch", "--depth", "1", "origin", sha], cwd=cwd, echo=False)
+        op.run(["git", "-c", "advice.detachedHead=false", "checkout", "FETCH_HEAD"], cwd=cwd, echo=False)
+
+
+def _repository_cache() -> cache.DirectoryCache:
+    if env.is_local():
+        root = env.tempdir().joinpath("repos")
+    else:
+        # remote job do not clone repo multiple times
+        root = env.cachedir().joinpath("repos")
+    return cache.shared(root, env.cache_max_bytes("repo", 1024))
+
 
 class Handler:
     """Load user module/package/script and run specific function"""
 
-    def __init__(self, loader: HandlerLoader):
-        """user defined script package/module"""
+    def __init__(self, loader: HandlerLoader, after: T.Sequence[str] = (), requirements=None):
+        """user defined script package/module
+
+        Args:
+            loader (HandlerLoader): package loader
+            after (list[str]): handler names which must finish before this handler runs
+            requirements: list of requirement specifiers or path of requirements file, installed on deploy
+        """
         self._loader = loader
         self._mod = None
+        self._deployed = False
+        self.after = list(after)
+        self.requirements = requirements
+        self.site_dir: T.Optional[pathlib.Path] = None
 
     @property
     def name(self):
         """module/package name in configuration or automatically named"""
         return self._loader.module_name
 
+    @property
+    def deployed(self) -> bool:
+        """Return True if deployed"""
+        return self._deployed
+
     def deploy(self):
-        """Deploy backyard package files"""
+        """Deploy backyard package files, and install requirements into a cached site directory"""
         self._loader.deploy()
+        if self.requirements is not None:
+            self.site_dir = ops.Operation().install_site(self.requirements, name=self.name)
+            _add_site_dir(self.site_dir)
+        self._deployed = True
+
+    def may_define(self, func_name: str) -> bool:
+        """Return False if the handler surely does not define the function, checked without deploy and import"""
+        try:
+            names = index.function_names(self._loader.source_path())
+        except Exception as e:  # pylint: disable=broad-except
+            L.verbose2("%s: failed to index: %s", self.name, e)
+            return True  # deploy reports the error
+        return names is None or func_name in names
 
     def get_function(self, func_name: str):
         """Run function corresponding to the action name
@@ -158,14 +245,37 @@ class Handler:
         return getattr(self._mod, func_name, None)
 
     def _load_module(self):
+        if not self._deployed:
+            raise exception.DandoriError(f"{self.name}: handler is not deployed yet")
         if self._mod is None:
             self._mod = self._loader.load_module()
 
 
+def _add_site_dir(site_dir: pathlib.Path):
+    """Append site directory of handler requirements to sys.path, packages of dandori's environment take priority"""
+    with _SYS_PATH_LOCK:
+        if str(site_dir) not in sys.path:
+            sys.path.append(str(site_dir))
+            importlib.invalidate_caches()
+
+
+CHECK_MODES = ("per_handler", "umbrella")
+
+
+@dataclasses.dataclass
+class CheckConfig:
+    mode: str = "per_handler"  # per_handler: one check run per handler, umbrella: one check run for all handlers
+    name: str = "dandori"  # name of umbrella check run
+    defer: float = 0.0  # create check run only if handlers run longer than this seconds
+
+
 @dataclasses.dataclass
 class Config:
     handlers: list[Handler]
     local: bool = False  # Run in local mode or not
+    max_workers: int = 1  # Run handlers concurrently if greater than 1
+    deploy_workers: int = 4  # Number of handlers deployed at the same time
+    checks: CheckConfig = dataclasses.field(default_factory=CheckConfig)
     cwd: pathlib.Path = pathlib.Path(".").absolute()  # current directory at instance generation point
     options: Box = dataclasses.field(default_factory=Box)
 
@@ -202,7 +312,12 @@ class ConfigLoader:
         L.debug("Config: %s", pprint.pformat(conf))
         self._setup_git(conf)
         return Config(
-            local=env.is_local(), handlers=self._parse_handlers(conf, path.parent), options=self._parse_options(conf)
+            local=env.is_local(),
+            handlers=self._sort_handlers(self._parse_handlers(conf, path.parent)),
+            max_workers=self._parse_workers(conf, "max_workers", 1),
+            deploy_workers=self._parse_workers(conf, "deploy_workers", 4),
+            checks=self._parse_checks(conf),
+            options=self._parse_options(conf),
         )
 
     def _parse_handlers(self, conf: dict, basedir: pathlib.Path):
@@ -212,36 +327,89 @@ class ConfigLoader:
         - string: local directory
         - {'name', 'path'}: local directory with package name
         - {'name', 'git': <git config>}: git repo
+
+        dict spec can have 'after': [<handler name>, ...] to run after other handlers,
+        'deploy_mode' to override top level deploy_mode, and 'requirements': [<specifier>, ...]
+        or <path of requirements file> to install packages used by the handler
         """
         rootdir = env.tempdir().joinpath("handlers")
         rootdir.mkdir(exist_ok=True)
         rootdir.joinpath("__init__.py").touch()
         handlers = []
+        deploy_mode = conf.get("deploy_mode", "copy")
         for i, d in enumerate(conf.get("handlers", [])):
+            after = []
+            requirements = None
             if isinstance(d, str):
                 name = f"package_{i}"
                 path = pathlib.Path(d)
                 if not path.is_absolute():
                     path = basedir.joinpath(path)
-                loader = LocalHandlerLoader(name=name, path=path)
+                loader = LocalHandlerLoader(name=name, path=path, deploy_mode=deploy_mode)
             elif isinstance(d, dict):
                 name = d.get("name", f"package_{i}")
+                mode = d.get("deploy_mode", deploy_mode)
                 if "git" in d:
                     gd = d["git"]
-                    loader = GitHandlerLoader(name=name, **gd)
+                    loader = GitHandlerLoader(name=name, deploy_mode=mode, **gd)
                 elif "path" in d:
                     path = pathlib.Path(d["path"])
                     if not path.is_absolute():
                         path = basedir.joinpath(path)
-                    loader = LocalHandlerLoader(name=name, path=path)
+                    loader = LocalHandlerLoader(name=name, path=path, deploy_mode=mode)
                 else:
                     raise ValueError("Need at least one key: [path, git]")
+                after = d.get("after", [])
+                if isinstance(after, str):
+                    after = [after]
+                requirements = d.get("requirements")
+                if isinstance(requirements, str):
+                    requirements = pathlib.Path(requirements)
+                    if not requirements.is_absolute():
+                        requirements = basedir.joinpath(requirements)
+                elif requirements is not None:
+                    requirements = list(requirements)
             else:
                 raise ValueError(f"handlers.{i} must be dict or str")
-            handlers.append(Handler(loader))
+            handlers.append(Handler(loader, after=after, requirements=requirements))
             L.verbose3("Add handlers: %s", name)
         return handlers
 
+    def _sort_handlers(self, handlers: list[Handler]) -> list[Handler]:
+        """Sort handlers topologically by 'after', keeping configured order as much as possible"""
+        names = {h.name for h in handlers}
+        for handler in handlers:
+            for name in handler.after:
+                if name not in names:
+                    raise ValueError(f"{handler.name}: unknown handler in after: {name}")
+        sorted_handlers: list[Handler] = []
+        done: set[str] = set()
+        rest = list(handlers)
+        while rest:
+            ready = [h for h in rest if done.issuperset(h.after)]
+            if not ready:
+                raise ValueError(f"Circular dependency in after: {', '.join(h.name for h in rest)}")
+            sorted_handlers.append(ready[0])
+            done.add(ready[0].name)
+            rest.remove(ready[0])
+        return sorted_handlers
+
+    def _parse_workers(self, conf: Box, key: str, default: int) -> int:
+        workers = int(conf.get(key, default))
+        if workers < 1:
+            raise ValueError(f"{key} must be positive: {workers}")
+        return workers
+
+    def _parse_checks(self, conf: Box) -> CheckConfig:
+        checks = conf.get("checks", {})
+        mode = checks.get("mode", "per_handler")
+        if mode not in CHECK_MODES:
+            raise ValueError(f"checks.mode must be one of {CHECK_MODES}: {mode}")
+        defer = float(checks.get("defer", 0.0))
+        if defer < 0:
+            raise ValueError(f"checks.defer must not be negative: {defer}")
+        return CheckConfig(mode=mode, name=checks.get("name", "dandori"), defer=defer)
+
     def _parse_options(self, conf: Box):
         return conf.get("options", Box())
 
@@ -3,10 +3,11 @@ from __future__ import annotations
 import dataclasses
 import typing as T
 
-import dandori.config
-import dandori.gh
-import dandori.ops
-import dandori.response
+if T.TYPE_CHECKING:
+    import dandori.config
+    import dandori.gh
+    import dandori.ops
+    import dandori.response
 
 
 @dataclasses.dataclass
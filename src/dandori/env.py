@@ -3,6 +3,7 @@ from __future__ import annotations
 import os
 import pathlib
 import tempfile
+import typing as T
 
 TEMP_DIR = None
 
@@ -24,3 +25,19 @@ def tempdir() -> pathlib.Path:
 def cachedir() -> pathlib.Path:
     """globel cache dir"""
     return pathlib.Path(os.environ.get("XDG_CACHE_DIR", "~/.cache")).joinpath("dandori").expanduser().resolve()
+
+
+def cache_max_bytes(name: str, default_mb: int) -> int:
+    """size limit of a cache in bytes. DANDORI_{NAME}_CACHE_MAX_MB overrides it (0 means unlimited)"""
+    return int(os.environ.get(f"DANDORI_{name.upper()}_CACHE_MAX_MB", default_mb)) * 1024 * 1024
+
+
+def handler_index_disabled() -> bool:
+    """DANDORI_HANDLER_INDEX=0 disables static handler index, all handlers are deployed and imported"""
+    return os.environ.get("DANDORI_HANDLER_INDEX") == "0"
+
+
+def record_path() -> T.Optional[pathlib.Path]:
+    """DANDORI_RECORD=<path> appends GitHub API responses to the cassette for `dandori bench`"""
+    path = os.environ.get("DANDORI_RECORD")
+    return pathlib.Path(path).expanduser().resolve() if path else None
@@ -11,3 +11,16 @@ class Cancel(DandoriError):
 
 class Failure(DandoriError):
     """Failure"""
+
+
+class DeployError(DandoriError):
+    """Failed to deploy one or more handlers"""
+
+    def __init__(self, errors: dict[str, BaseException]):
+        """errors: handler name -> raised exception"""
+        super().__init__("Failed to deploy handlers: " + ", ".join(f"{k}: {v}" for k, v in errors.items()))
+        self.errors = errors
+
+
+class Timeout(DandoriError):
+    """Waited too long"""
@@ -1,49 +1,137 @@
 from __future__ import annotations
 
+import concurrent.futures
 import contextlib
+import contextvars
+import json
 import os
 import pathlib
+import threading
 import time
 import typing as T
 import urllib.error
 
 from box import Box
-from ghapi.all import GhApi
 
+import dandori.checkout
+import dandori.checks
+import dandori.env
 import dandori.exception
+import dandori.git
 import dandori.log
 import dandori.ops
+import dandori.payload
+import dandori.poll
+import dandori.prefetch
 
 HTTPError = urllib.error.HTTPError
 URLError = urllib.error.URLError
 
+if T.TYPE_CHECKING:
+    import dandori.transport
+
 L = dandori.log.get_logger(__name__)
 
 
 class GitHub:
-    def __init__(self):
-        """Read GitHub Actions info automatically, and provide some convenient methods"""
-        self._path = pathlib.Path(os.environ["GITHUB_EVENT_PATH"])
-        self.repository: str = os.environ["GITHUB_REPOSITORY"]
-        self.event_name: str = os.environ["GITHUB_EVENT_NAME"]
-        self.sha: str = os.environ["GITHUB_SHA"]
-        self.ref: str = os.environ["GITHUB_REF"]
-        self.workflow: str = os.environ["GITHUB_WORKFLOW"]
-        self.action: str = os.environ["GITHUB_ACTION"]
-        self.actor: str = os.environ["GITHUB_ACTOR"]
-        self.job: str = os.environ["GITHUB_JOB"]
-        self.run_number: int = int(os.environ["GITHUB_RUN_NUMBER"])
-        self.run_id: int = int(os.environ["GITHUB_RUN_ID"])
-        self.payload: Box = Box()
-        if self._path.exists():
-            self.payload = Box.from_json(filename=str(self._path))
-        self.api = GhApi(owner=self.owner, repo=self.name)
+    def __init__(
+        self,
+        environ: T.Optional[T.Mapping[str, str]] = None,
+        payload: T.Optional[dict] = None,
+        api: T.Optional[dandori.transport.Client] = None,
+        checkout: bool = True,
+    ):
+        """Read GitHub Actions info automatically, and provide some convenient methods
+
+        Args:
+            environ: GITHUB_* variables, os.environ by default
+            payload (dict): event payload, read from GITHUB_EVENT_PATH by default
+            api: API client shared with other instances, see `create_api`
+            checkout (bool): check out the pull request on pull_request_comment events
+        """
+        environ = os.environ if environ is None else environ
+        if payload is None:
+            self._path: pathlib.Path = pathlib.Path(environ["GITHUB_EVENT_PATH"])
+        else:
+            self._path = pathlib.Path(environ.get("GITHUB_EVENT_PATH", ""))
+        self.repository: str = environ["GITHUB_REPOSITORY"]
+        self.event_name: str = environ["GITHUB_EVENT_NAME"]
+        self.sha: str = environ["GITHUB_SHA"]
+        self.ref: str = environ["GITHUB_REF"]
+        self.workflow: str = environ["GITHUB_WORKFLOW"]
+        self.action: str = environ["GITHUB_ACTION"]
+        self.actor: str = environ["GITHUB_ACTOR"]
+        self.job: str = environ["GITHUB_JOB"]
+        self.run_number: int = int(environ["GITHUB_RUN_NUMBER"])
+        self.run_id: int = int(environ["GITHUB_RUN_ID"])
+        self._payload: T.Optional[dandori.payload.Payload] = None
+        if payload is not None:
+            self._payload = dandori.payload.Payload(payload)
+        self._api: T.Optional[dandori.transport.Client] = api
+        self._api_lock = threading.Lock()
         self._pull_request = None
+        self._snapshot: T.Optional[dandori.prefetch.Snapshot] = None
+        self._snapshot_fetched = False
+        self._snapshot_lock = threading.Lock()
+        self._snapshot_checks_used = False  # check runs of the snapshot are served only for the first read
+        self._tags: T.Optional[set[str]] = None
+        self._tags_loaded = environ is not None or payload is not None or api is not None  # not for serve/bench
+        self._tags_lock = threading.Lock()
+        self._latest_release_tag: T.Optional[str] = None
+        self._umbrella: T.Optional[dandori.checks.Umbrella] = None
+        self._check_names: set[str] = set()  # check runs created by this process
         #
         if self.event_name == "issue_comment":
             if self.is_pull_request():
                 self.event_name = "pull_request_comment"
-                self._checkout_pull_request_branch()
+                if checkout:
+                    self.checkout_pull_request(dandori.checkout.from_env(self.comment_body()))
+
+    @property
+    def payload(self) -> dandori.payload.Payload:
+        """Event payload. It is loaded at first access"""
+        if self._payload is None:
+            data = {}
+            if self._path.exists():
+                with self._path.open(encoding="utf-8") as fi:
+                    data = json.load(fi)
+            self._payload = dandori.payload.Payload(data)
+        return self._payload
+
+    @property
+    def api(self) -> dandori.transport.Client:
+        """GitHub API client (GhApi). It is created at first access"""
+        with self._api_lock:
+            if self._api is None:
+                self._api = self.create_api(self.owner, self.name)
+        return self._api
+
+    @staticmethod
+    def create_api(owner: str, name: str) -> dandori.transport.Client:
+        """Create API client of the repository with the response cache
+
+        With DANDORI_RECORD, responses are recorded without the cache so that all requests are in the cassette.
+        """
+        import dandori.transport  # pylint: disable=import-outside-toplevel  # ghapi is slow to import
+
+        record_path = dandori.env.record_path()
+        if record_path is not None:
+            import dandori.cassette  # pylint: disable=import-outside-toplevel
+
+            L.verbose1("Record GitHub API responses to %s", record_path)
+            return dandori.transport.Client(owner=owner, repo=name, cassette=dandori.cassette.Recorder(record_path))
+        return dandori.transport.Client(
+            owner=owner,
+            repo=name,
+            cache=dandori.transport.ResponseCache(
+                dandori.env.cachedir().joinpath("http"), dandori.env.cache_max_bytes("http", 100)
+            ),
+        )
+
+    @property
+    def api_created(self) -> bool:
+        """Return True if API client has been used"""
+        return self._api is not None
 
     @property
     def owner(self) -> str:
@@ -64,6 +152,15 @@ class GitHub:
             return self.payload["pull_request"]["number"]
         return None
 
+    def prefetch(self) -> T.Optional[dandori.prefetch.Snapshot]:
+        """Fetch pull request context by one GraphQL query at first call. Set DANDORI_GITHUB_PREFETCH=0 to disable"""
+        with self._snapshot_lock:
+            if not self._snapshot_fetched:
+                self._snapshot_fetched = True
+                if self.is_pull_request() and self.issue_number and os.environ.get("DANDORI_GITHUB_PREFETCH") != "0":
+                    self._snapshot = dandori.prefetch.fetch(self.api, self.owner, self.name, self.issue_number)
+        return self._snapshot
+
     def pull_request(self, number: int = None) -> Box:
         """Get pull request details"""
         try:
@@ -81,6 +178,17 @@ class GitHub:
                 return Box()
             raise
 
+    def pull_request_summary(self) -> Box:
+        """Pull request of the event with common fields, from the prefetched snapshot without REST API request
+
+        The fields are number, title, body, state, merged, draft, mergeable, html_url, user, merge_commit_sha,
+        head, base and labels. Use pull_request() for the full REST API response.
+        """
+        snapshot = self.prefetch()
+        if snapshot is not None:
+            return snapshot.pull_request
+        return self.pull_request()
+
     def is_pull_request(self):
         """event is related to pull request (pull request, pull request comment)"""
         if self.event_name == "pull_request":
@@ -90,26 +198,61 @@ class GitHub:
         return False
 
     def latest_release_tag(self) -> str:
-        """Return latest relesed tag"""
-        try:
-            resp = self.api.get_latest_release()
-        except HTTPError as e:
-            if e.code == 404:
-                return ""
-        return resp.tag_name
+        """Return latest relesed tag. It is fetched once per run"""
+        if self._latest_release_tag is None:
+            snapshot = self.prefetch()
+            if snapshot is not None:
+                self._latest_release_tag = snapshot.latest_release_tag
+            else:
+                try:
+                    self._latest_release_tag = self.api.repos.get_latest_release().tag_name
+                except HTTPError as e:
+                    if e.code != 404:
+                        raise
+                    self._latest_release_tag = ""
+        return self._latest_release_tag
 
     def has_tag(self, tag: str) -> bool:
         """Check a tag already exists"""
+        snapshot = self.prefetch()
+        if snapshot is not None:
+            if tag in snapshot.tags:
+                return True
+            elif snapshot.tags_complete:
+                return False
+        tags = self.tag_index()
+        if tags is not None:
+            return tag in tags
         results = self.api.list_tags(tag)
         refs = [x.ref for x in results]
         return f"refs/tags/{tag}" in refs
 
+    def tag_index(self) -> T.Optional[set[str]]:
+        """All tag names of origin listed by one `git ls-remote --tags` per run
+
+        None if the current directory is not a checkout of this repository, or GitHub is created with explicit
+        environ/payload/api (serve and bench), where the checkout is not of the event repository.
+        """
+        with self._tags_lock:
+            if not self._tags_loaded:
+                self._tags_loaded = True
+                origin = dandori.git.remote_repository("origin") if pathlib.Path(".git").exists() else None
+                if origin is not None and origin.lower() != self.repository.lower():
+                    L.verbose1("Use API to find tags: origin is %s, not %s", origin, self.repository)
+                elif origin is not None:
+                    try:
+                        refs = dandori.git.ls_remote("origin", tags=True)
+                        self._tags = {ref[len("refs/tags/") :].replace("^{}", "") for _, ref in refs}
+                    except dandori.exception.DandoriError as e:
+                        L.verbose1("Use API to find tags: %s", e)
+            return self._tags
+
     def has_label(self, name: T.Union[str, frozenset[str], set[str], list[str], tuple[str]]) -> bool:
         """Return True if issue/pull_request has an label"""
         labels = self.payload.get("issue", {}).get("labels")
         if not labels:
             if self.is_pull_request():
-                pr = self.pull_request()
+                pr = self.pull_request_summary()
                 if pr and "labels" in pr:
                     labels = pr["labels"]
         if labels:
@@ -148,41 +291,215 @@ class GitHub:
         return self.payload.get("comment", {}).get("body", "")
 
     def create_release(self, *args, **kwargs):
-        """Shorthand for api.create_release"""
-        self.api.create_release(*args, **kwargs)
+        """Shorthand for api.create_release
+
+        The tag index, the prefetched snapshot and the latest release tag are updated with the new release.
+        The cached `releases/latest` response is dropped by the write request.
+        """
+        rel = self.api.create_release(*args, **kwargs)
+        with self._tags_lock:
+            if self._tags is not None:
+                self._tags.add(rel.tag_name)
+        latest = not rel.get("draft") and not rel.get("prerelease")  # drafts and prereleases are not the latest
+        with self._snapshot_lock:
+            snapshot = self._snapshot  # not fetched here if it is not used yet
+        if snapshot is not None:
+            snapshot.tags.add(rel.tag_name)
+            if latest:
+                snapshot.latest_release_tag = rel.tag_name
+        if latest:
+            self._latest_release_tag = rel.tag_name
+        return rel
 
-    def cancel(self):
-        """Cancel this workflow"""
+    def cancel(self, timeout: float = 10.0):
+        """Cancel this workflow and wait until the cancellation is acknowledged, at most timeout seconds"""
         self.api.actions.cancel_workflow_run(self.run_id)
-        time.sleep(10)
+        try:
+            # this job is still running, so the run never completes while we wait
+            dandori.poll.poll(
+                lambda: self.api.actions.get_workflow_run(self.run_id),
+                lambda run: "cancelled" in (run.status, run.conclusion),
+                timeout=timeout,
+                interval=1.0,
+                max_interval=5.0,
+            )
+        except dandori.exception.Timeout:
+            L.verbose1("Cancellation of workflow run %s is not acknowledged in %g seconds", self.run_id, timeout)
+
+    def wait_for_checks(
+        self,
+        names: T.Optional[T.Iterable[str]] = None,
+        sha=None,
+        timeout: float = 600.0,
+        interval: float = 5.0,
+        ignore=(),
+        grace: float = 30.0,
+    ) -> list[Box]:
+        """Wait until check runs of the sha complete and return them
+
+        Args:
+            names: check names to wait for. If None, all check runs except this job and
+                check runs created by this process
+            sha (str): commit sha (default: head of pull request or GITHUB_SHA)
+            timeout (float): overall deadline in seconds
+            interval (float): first polling interval in seconds, which grows up to 60 seconds
+            ignore: check names not to wait for
+            grace (float): seconds to keep waiting while no check runs exist yet, because other
+                workflows may not have created theirs
+
+        Raises:
+            dandori.exception.Timeout: check runs did not complete before the deadline
+        """
+        sha = self._check_sha(sha)
+        wanted = None if names is None else set(names)
+        with self._snapshot_lock:
+            ignored = set(ignore) | {self.job} | self._check_names
+
+        def fetch():
+            runs = self.iter_pages(self.api.checks.list_for_ref, key="check_runs", ref=sha, filter="latest")
+            if wanted is not None:
+                return [x for x in runs if x.name in wanted]
+            return [x for x in runs if x.name not in ignored]
+
+        started = time.monotonic()
+
+        def done(runs):
+            if wanted is not None and not wanted.issubset(x.name for x in runs):
+                return False
+            if not runs and time.monotonic() - started < grace:
+                return False
+            return all(x.status == "completed" for x in runs)
+
+        return dandori.poll.poll(fetch, done, timeout=timeout, interval=interval, max_interval=60.0)
 
     def list_checks(self, sha=None, name=None, status=None):
         """Get check runs and return"""
-        if self.is_pull_request():
-            pr = self.pull_request()
-            sha = pr.head.sha
-        else:
-            sha = self.sha
+        return list(self.iter_checks(sha=sha, name=name, status=status))
+
+    def iter_checks(self, sha=None, name=None, status=None) -> T.Iterator[Box]:
+        """Iterate check runs of the sha (default: head of pull request or GITHUB_SHA)
+
+        The first read without status is served from the prefetched snapshot, later reads ask the API for live status.
+        """
+        if sha is None:
+            if self.is_pull_request():
+                sha = self.pull_request_summary().head.sha
+            else:
+                sha = self.sha
+        snapshot = self.prefetch() if status is None else None
+        if snapshot is not None and snapshot.check_runs_complete and snapshot.head_sha == sha:
+            with self._snapshot_lock:
+                use_snapshot, self._snapshot_checks_used = not self._snapshot_checks_used, True
+            if use_snapshot:
+                for x in snapshot.check_runs:
+                    if name is None or x.name == name:
+                        yield x
+                return
         kwargs = {"ref": sha}
         if name is not None:
             kwargs["check_name"] = name
         if status is not None:
             kwargs["status"] = status
-        checks = self.api.checks.list_for_ref(per_page=100, **kwargs)
-        return [Box(x) for x in checks.check_runs]
+        yield from self.iter_pages(self.api.checks.list_for_ref, key="check_runs", **kwargs)
 
-    @contextlib.contextmanager
-    def check(self, name: str, sha=None):
-        """Some proc with GitHub Checks API"""
+    def iter_comments(self, number: T.Optional[int] = None) -> T.Iterator[Box]:
+        """Iterate comments of the issue/pull_request (default: issue of the event)"""
+        yield from self.iter_pages(self.api.issues.list_comments, self._number(number))
+
+    def iter_files(self, number: T.Optional[int] = None) -> T.Iterator[Box]:
+        """Iterate changed files of the pull request (default: pull request of the event)"""
+        yield from self.iter_pages(self.api.pulls.list_files, self._number(number))
+
+    def iter_labels(self, number: T.Optional[int] = None) -> T.Iterator[Box]:
+        """Iterate labels of the issue/pull_request (default: issue of the event)"""
+        yield from self.iter_pages(self.api.issues.list_labels_on_issue, self._number(number))
+
+    def iter_pages(
+        self, oper, *args, key: T.Optional[str] = None, per_page: int = 100, prefetch: bool = True, **kwargs
+    ):
+        """Iterate items of a paginated API page by page
+
+        Stop iteration to avoid fetching remaining pages. The next page is fetched in background while
+        the current page is consumed if prefetch is True.
+
+        Args:
+            oper: API operation like `ctx.gh.api.issues.list_comments`
+            key (str): key of the item list if the response is an object (e.g. "check_runs")
+            per_page (int): page size, at most 100 which is the max of GitHub API
+            prefetch (bool): fetch next page concurrently
+        """
+        per_page = min(per_page, 100)  # GitHub returns at most 100 items, a full page must not look like the last
+
+        def fetch(page):
+            r = oper(*args, per_page=per_page, page=page, **kwargs)
+            return r[key] if key else r
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            page = 1
+            items = fetch(page)
+            while True:
+                next_items = None
+                if executor is not None and len(items) >= per_page:
+                    next_items = executor.submit(contextvars.copy_context().run, fetch, page + 1)
+                for item in items:
+                    yield Box(item)
+                if len(items) < per_page:
+                    return
+                page += 1
+                items = next_items.result() if next_items is not None else fetch(page)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    def _number(self, number: T.Optional[int]) -> int:
+        if number is None:
+            number = self.issue_number
+        if not number:
+            raise ValueError("issue number not found.")
+        return number
+
+    def _add_check_name(self, name: str):
+        """Remember a check run created by this process, the prefetched check runs are outdated by it"""
+        with self._snapshot_lock:
+            self._check_names.add(name)
+            self._snapshot_checks_used = True
+
+    def _check_sha(self, sha: T.Optional[str]) -> str:
         if sha is None:
             if self.is_pull_request():
-                sha = self.pull_request()["head"]["sha"]
+                sha = self.pull_request_summary()["head"]["sha"]
             elif self.sha:
                 sha = self.sha
+        if not sha:
+            raise dandori.exception.DandoriError("head sha of check runs is unknown, pass sha explicitly")
+        return sha
+
+    @contextlib.contextmanager
+    def check(self, name: str, sha=None, defer: float = 0.0):
+        """Some proc with GitHub Checks API
+
+        Yield the check run to add annotations and output. Inside `umbrella_check`,
+        the proc is reported as a part of the umbrella check run instead of its own check run.
+
+        Args:
+            name (str): check name
+            sha (str): commit sha, head of pull request or GITHUB_SHA by default
+            defer (float): create the check run only if the proc runs longer than this seconds
+        """
+        umbrella = self._umbrella
+        run: T.Union[dandori.checks.CheckRun, dandori.checks.SubCheck]
+        if umbrella is not None:
+            run = dandori.checks.SubCheck(umbrella.run, name)
+        else:
+            check_run = dandori.checks.CheckRun(self.api, name, self._check_sha(sha), defer=defer)
+            check_run.start()
+            self._add_check_name(name)
+            run = check_run
+        token = dandori.checks.set_current(run)
+        conclusion = "success"
         try:
-            conclusion = "success"
-            check = self.api.checks.create(name=name, head_sha=sha, status="in_progress")
-            yield
+            yield run
         except dandori.exception.Cancel:
             conclusion = "cancelled"
             raise
@@ -190,25 +507,102 @@ class GitHub:
             conclusion = "failure"
             raise
         finally:
-            self.api.checks.update(name=name, check_run_id=check.id, status="completed", conclusion=conclusion)
+            dandori.checks.reset_current(token)
+            if isinstance(run, dandori.checks.CheckRun):
+                run.finish(conclusion)
+            elif umbrella is not None:
+                umbrella.report(name, conclusion)
+
+    @contextlib.contextmanager
+    def umbrella_check(self, name: str, sha=None, defer: float = 0.0):
+        """Report all `check` inside this block as one check run
+
+        Conclusion of the umbrella is the worst conclusion of its parts.
+        """
+        run = dandori.checks.CheckRun(self.api, name, self._check_sha(sha), defer=defer)
+        run.start()
+        self._add_check_name(name)
+        umbrella = dandori.checks.Umbrella(run)
+        self._umbrella = umbrella
+        try:
+            yield run
+        except dandori.exception.Cancel:
+            umbrella.conclusion = dandori.checks.worse(umbrella.conclusion, "cancelled")
+            raise
+        except Exception:
+            umbrella.conclusion = dandori.checks.worse(umbrella.conclusion, "failure")
+            raise
+        finally:
+            self._umbrella = None
+            run.finish(umbrella.conclusion or "neutral")
+
+    def annotate(
+        self, path: str, start_line: int, message: str, end_line: T.Optional[int] = None, level="notice", **kwargs
+    ):
+        """Add an annotation to the current check run
+
+        Args:
+            path (str): file path relative to the repository root
+            start_line (int): line number
+            message (str): annotation message
+            end_line (int): last line number, same as start_line by default
+            level (str): notice, warning or failure
+            kwargs: other annotation fields like title, raw_details
+        """
+        run = dandori.checks.current()
+        if run is None:
+            raise dandori.exception.DandoriError("annotate must be called inside check")
+        run.annotate(path, start_line, message, end_line, level, **kwargs)
+
+    def set_check_output(
+        self, title: T.Optional[str] = None, summary: T.Optional[str] = None, text: T.Optional[str] = None
+    ):
+        """Set output of the current check run"""
+        run = dandori.checks.current()
+        if run is None:
+            raise dandori.exception.DandoriError("set_check_output must be called inside check")
+        run.set_output(title, summary, text)
+
+    def checkout_pull_request(self, strategy="full", depth: T.Optional[int] = None, paths: T.Sequence[str] = ()):
+        """Check out merge commit (or head if not mergeable) of the pull request
 
-    def _checkout_pull_request_branch(self):
-        if pathlib.Path(".git").is_dir():
-            ops = dandori.ops.Operation()
-            pr = self.pull_request()
-            ref = pr.get("merge_commit_sha")
-            if not ref:
-                L.debug("Seems not mergeable. check out head branch instead")
-                ref = pr.head.sha
-            L.info("Checkout to merge commit of PR #%d: %s", self.issue_number, ref)
-            ops.run(["git", "fetch", "origin", f"+{ref}:refs/remotes/origin/merge_commit"])
-            ops.run(["git", "checkout", "--force", "-B", "merge_commit", "refs/remotes/origin/merge_commit"])
+        On pull_request_comment events, dandori checks out by the strategy in DANDORI_CHECKOUT before loading handlers.
+        Handlers can call this to check out again, e.g. after `skip`.
+
+        Args:
+            strategy: full, shallow, partial (no blobs until needed), sparse (only paths) or skip.
+                `dandori.checkout.Strategy` or a spec like "shallow:10", "sparse:src,docs" is also accepted
+            depth (int): fetch depth, overrides the depth of the strategy
+            paths: paths checked out by sparse strategy, override the paths of the strategy
+        """
+        if isinstance(strategy, str):
+            strategy = dandori.checkout.Strategy.parse(strategy)
+        if depth is not None or paths:
+            strategy = dandori.checkout.Strategy(
+                strategy.name, depth=depth or strategy.depth, paths=tuple(paths) or strategy.paths
+            )
+        if not pathlib.Path(".git").is_dir():
+            return
+        pr = self.pull_request_summary()
+        ref = pr.get("merge_commit_sha")
+        if not ref:
+            L.debug("Seems not mergeable. check out head branch instead")
+            ref = pr.head.sha
+        L.info("Checkout to merge commit of PR #%d (%s): %s", self.issue_number, strategy.name, ref)
+        dandori.checkout.checkout(dandori.ops.Operation(), ref, strategy)
 
 
 class GitHubMock:
-    def __init__(self, chain=None):
-        """GitHub API Mock"""
+    def __init__(self, chain=None, event_name: T.Optional[str] = None):
+        """GitHub API Mock
+
+        Args:
+            chain: names of attributes accessed so far
+            event_name (str): event name of the mock, it is a mock too if not given
+        """
         self._chain = [] if chain is None else chain
+        if event_name is not None:
+            self.event_name = event_name
 
     def __call__(self, *args, **kwargs):
         """call outputs what api called"""
@@ -219,7 +613,13 @@ class GitHubMock:
     def check(self, *args, **kwargs):
         """log check"""
         L.info("[Call GitHub API] check(%s, %s)", args, kwargs)
-        yield
+        yield GitHubMock(["check"])
+
+    @contextlib.contextmanager
+    def umbrella_check(self, *args, **kwargs):
+        """log umbrella check"""
+        L.info("[Call GitHub API] umbrella_check(%s, %s)", args, kwargs)
+        yield GitHubMock(["umbrella_check"])
 
     def __getattr__(self, name):
         return GitHubMock(self._chain + [name])
@@ -1,41 +1,44 @@
+from __future__ import annotations
+
+import contextlib
+import functools
 import os
 import pathlib
+import re
+import typing as T
 import weakref
 
 import dandori.log
-from dandori import env, ops
+from dandori import env, exception, ops
+
+L = dandori.log.get_logger(__name__)
 
 SETUP_GIT = None
+CONFIG_ENV_GIT_VERSION = (2, 31)  # GIT_CONFIG_COUNT/GIT_CONFIG_KEY_n/GIT_CONFIG_VALUE_n
 
 
 class SetupGit:
     def __init__(self, option):
-        """Setup git configuration for whole dandori process"""
-        self._ssh_to_https = option.get("ssh_to_https", True)
-        self.obj = self._setup()
-        self._finalizer = weakref.finalize(self, self._cleanup, self.obj)
+        """Setup git configuration for whole dandori process
 
-    @classmethod
-    def _cleanup(cls, obj):
-        # restore original git config
-        if "git_config_path" in obj:
-            with obj["git_config_path"].open("wb") as fo:
-                fo.write(obj["git_config_content"])
+        Configuration is passed to git by GIT_CONFIG_COUNT/GIT_CONFIG_KEY_n/GIT_CONFIG_VALUE_n environment variables
+        (git >= 2.31), so global config files are never touched. Only `git --version` is run to check it.
+        Older git ignores them, then the global config is changed and restored at exit.
+        """
+        self._ssh_to_https = option.get("ssh_to_https", True)
+        self._finalizer = None
+        self._setup()
 
     def _setup(self):
         if "DANDORI_GITHUB_TOKEN" in os.environ:
             os.environ["GITHUB_TOKEN"] = os.environ["DANDORI_GITHUB_TOKEN"]
-        robj = {}
         if not env.is_local():
             bindir = env.tempdir().joinpath("bin")
             bindir.mkdir()
             if os.environ.get("PATH"):
                 os.environ["PATH"] = f"{bindir}:{os.environ['PATH']}"
-            self._backup_global_git_config(robj)
             self._setup_git_cred_helper(bindir)
 
-        return robj
-
     def _setup_git_cred_helper(self, bindir: pathlib.Path):
         path = bindir.joinpath("git-credential-dandori-default")
         with path.open("w") as fo:
@@ -48,32 +51,88 @@ class SetupGit:
     """
             )
         path.chmod(0o755)
+        entries = [
+            ("url.https://github.com.insteadOf", "ssh://git@github.com"),
+            ("url.https://github.com.insteadOf", "git://git@github.com"),
+            ("url.https://github.com/.insteadOf", "git@github.com:"),
+            # the empty value drops helpers of config files, dandori-default answers for github.com first
+            ("credential.https://github.com.helper", ""),
+            ("credential.https://github.com.helper", "dandori-default"),
+        ]
+        if version() >= CONFIG_ENV_GIT_VERSION:
+            add_config(entries)
+        else:
+            self._add_global_config(entries)
+
+    def _add_global_config(self, entries: list[tuple[str, str]]):
+        """Add entries to the global config by `git config`, the original is restored at exit"""
+        p = pathlib.Path("~/.gitconfig").expanduser()
+        if not p.is_file() and pathlib.Path("~/.config/git/config").expanduser().is_file():
+            p = pathlib.Path("~/.config/git/config").expanduser()
+        content = p.read_bytes() if p.is_file() else None
+        self._finalizer = weakref.finalize(self, _restore_file, p, content)
         op = ops.Operation()
-        op.run(["git", "config", "--global", 'url."https://github.com".insteadOf', "ssh://git@github.com"])
-        op.run(["git", "config", "--global", "--add", 'url."https://github.com".insteadOf', "git://git@github.com"])
-        op.run(["git", "config", "--global", "--add", 'url."https://github.com/".insteadOf', "git@github.com:"])
-        # first to fetch a existant config
-        cred_helpers = ["dandori-default"]
-        r = op.run(["git", "config", "--global", "--get-all", "credential.helper"])
-        if r.stdout:
-            for line in (x.strip() for x in r.stdout.split()):
-                if line:
-                    cred_helpers.append(line)
-        # reset config
-        op.run(["git", "config", "--global", "--unset-all", "credential.helper"])
-        for helper in cred_helpers:
-            op.run(["git", "config", "--global", "--add", "credential.helper", helper])
+        for key, value in entries:
+            op.run(["git", "config", "--global", "--add", key, value])
         if dandori.log.get_levelname() == "DEBUG":
             op.run(["git", "config", "--global", "--list"])
 
-    def _backup_global_git_config(self, robj):
-        p = pathlib.Path("~/.gitconfig").expanduser()
-        if not p.is_file():
-            p = pathlib.Path("~/.config/git/config").expanduser()
-        if p.is_file():
-            robj["git_config_path"] = p
-            with p.open("rb") as f:
-                robj["git_config_content"] = f.read()
+
+def _restore_file(path: pathlib.Path, content: T.Optional[bytes]):
+    if content is None:
+        with contextlib.suppress(FileNotFoundError):
+            path.unlink()
+    else:
+        path.write_bytes(content)
+
+
+def add_config(entries: list[tuple[str, str]]):
+    """Add git config entries to this process and subprocesses by GIT_CONFIG_* environment variables
+
+    Entries are added after existing GIT_CONFIG_* entries, and multi-valued keys are appended
+    to values in config files (e.g. credential.helper).
+    """
+    count = int(os.environ.get("GIT_CONFIG_COUNT", "0") or "0")
+    for key, value in entries:
+        os.environ[f"GIT_CONFIG_KEY_{count}"] = key
+        os.environ[f"GIT_CONFIG_VALUE_{count}"] = value
+        L.debug("git config: %s=%s", key, value)
+        count += 1
+    os.environ["GIT_CONFIG_COUNT"] = str(count)
+
+
+@functools.lru_cache(maxsize=None)
+def version() -> tuple[int, ...]:
+    """Version of git command like (2, 39, 5), (0,) if it is unknown"""
+    r = ops.Operation().run(["git", "--version"], echo=False, check=False)
+    m = re.search(r"(\d+(?:\.\d+)+)", r.stdout) if r.returncode == 0 else None
+    if m is None:
+        L.warning("Failed to get git version: %s", r.stdout.strip())
+        return (0,)
+    return tuple(int(x) for x in m.group(1).split("."))
+
+
+def remote_repository(remote: str = "origin", cwd=None) -> T.Optional[str]:
+    """Return "owner/name" of the GitHub remote, None if it is not a GitHub repository or not a git checkout"""
+    r = ops.Operation().run(["git", "remote", "get-url", remote], echo=False, check=False, cwd=cwd)
+    if r.returncode != 0:
+        return None
+    m = re.search(r"github\.com[:/]([^/\s]+/[^/\s]+?)(?:\.git)?/?$", r.stdout.strip())
+    return m.group(1) if m else None
+
+
+def ls_remote(url: str, *patterns: str, tags: bool = False, cwd=None) -> list[tuple[str, str]]:
+    """List remote references as (sha, ref) without cloning. url can be a remote name like origin"""
+    args = ["git", "ls-remote"] + (["--tags"] if tags else []) + [url, *patterns]
+    r = ops.Operation().run(args, echo=False, check=False, cwd=cwd)
+    if r.returncode != 0:
+        raise exception.DandoriError(f"git ls-remote {url} failed: {r.stdout.strip()}")
+    refs = []
+    for line in r.stdout.splitlines():
+        if "\t" in line:
+            sha, ref = line.split("\t", 1)
+            refs.append((sha.strip(), ref.strip()))
+    return refs
 
 
 def setup(opt):
@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import ast
+import hashlib
+import json
+import pathlib
+import typing as T
+
+import dandori.cache
+import dandori.env
+import dandori.log
+
+L = dandori.log.get_logger(__name__)
+
+INDEX_VERSION = 1
+DYNAMIC_CALLS = ("globals", "exec", "setattr", "__import__")
+
+
+def function_names(source: pathlib.Path) -> T.Optional[set[str]]:
+    """Names defined at top level of a handler module/package, found by scanning sources statically
+
+    Names re-exported by relative imports (`from .pull_request import *`) are included.
+    Return None if the names cannot be decided statically (e.g. module level __getattr__, star import of
+    an absolute module) or the source does not exist, then the handler must be deployed and imported,
+    which reports the error.
+
+    Args:
+        source (pathlib.Path): handler file or package directory
+    """
+    if source.is_file():
+        return _Resolver().names(source)
+    if not source.is_dir():
+        L.verbose2("%s: source does not exist", source)
+        return None
+    init = source.joinpath("__init__.py")
+    if init.is_file():
+        return _Resolver().names(init)
+    return set()  # namespace package has no attributes
+
+
+def summarize(code: bytes) -> dict:
+    """Scan top level statements of a module
+
+    Return {"names": defined names, "stars": [[level, module], ...] relative star imports,
+    "all": literal __all__ or None, "dynamic": True if names cannot be decided}
+    """
+    summary: dict = {"names": [], "stars": [], "all": None, "dynamic": False}
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        summary["dynamic"] = True  # let import raise the error
+        return summary
+    for node in _top_level(tree.body):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            summary["names"].append(node.name)
+            if node.name == "__getattr__":
+                summary["dynamic"] = True
+        elif isinstance(node, (ast.Assign, ast.AnnAssign, ast.AugAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            for target in targets:
+                for name in ast.walk(target):
+                    if isinstance(name, ast.Name):
+                        summary["names"].append(name.id)
+            if any(isinstance(x, ast.Name) and x.id == "__all__" for x in targets) and node.value is not None:
+                try:
+                    summary["all"] = [str(x) for x in ast.literal_eval(node.value)]
+                except ValueError:
+                    summary["dynamic"] = True
+        elif isinstance(node, ast.Import):
+            for alias in node.names:
+                summary["names"].append(alias.asname or alias.name.split(".")[0])
+        elif isinstance(node, ast.ImportFrom):
+            for alias in node.names:
+                if alias.name != "*":
+                    summary["names"].append(alias.asname or alias.name)
+                elif node.level:
+                    summary["stars"].append([node.level, node.module or ""])
+                else:
+                    summary["dynamic"] = True
+        if isinstance(node, (ast.Expr, ast.Assign, ast.AnnAssign, ast.AugAssign)) and _has_dynamic_call(node):
+            summary["dynamic"] = True
+    return summary
+
+
+def _has_dynamic_call(node: ast.AST) -> bool:
+    """globals()/exec()/setattr() at top level may define names"""
+    for child in ast.walk(node):
+        if isinstance(child, ast.Call) and isinstance(child.func, ast.Name) and child.func.id in DYNAMIC_CALLS:
+            return True
+    return False
+
+
+def _top_level(body: list[ast.stmt]) -> T.Iterator[ast.stmt]:
+    """Statements executed at import, including all branches of if/try/with"""
+    for node in body:
+        yield node
+        if isinstance(node, (ast.If, ast.While, ast.For, ast.AsyncFor)):
+            yield from _top_level(node.body)
+            yield from _top_level(node.orelse)
+        elif isinstance(node, ast.Try):
+            yield from _top_level(node.body)
+            for handler in node.handlers:
+                yield from _top_level(handler.body)
+            yield from _top_level(node.orelse)
+            yield from _top_level(node.finalbody)
+        elif isinstance(node, (ast.With, ast.AsyncWith)):
+            yield from _top_level(node.body)
+
+
+def cached_summary(path: pathlib.Path) -> dict:
+    """summarize() of the file, cached by content hash"""
+    code = path.read_bytes()
+    digest = hashlib.sha256(b"%d\0" % INDEX_VERSION + code).hexdigest()
+    cache_path = dandori.env.cachedir().joinpath("index", digest[:2], digest + ".json")
+    try:
+        return json.loads(cache_path.read_bytes())
+    except (OSError, ValueError):
+        pass
+    summary = summarize(code)
+    try:
+        dandori.cache.atomic_write(cache_path, json.dumps(summary).encode("utf-8"))
+    except OSError as e:
+        L.debug("Failed to write index cache %s: %s", cache_path, e)
+    return summary
+
+
+class _Resolver:
+    def __init__(self):
+        """Resolve relative star imports between files"""
+        self._visiting: set[pathlib.Path] = set()
+
+    def names(self, path: pathlib.Path, public_only: bool = False) -> T.Optional[set[str]]:
+        path = path.resolve()
+        if path in self._visiting:
+            return set()  # circular import, names are collected by the outer visit
+        self._visiting.add(path)
+        try:
+            summary = cached_summary(path)
+            if summary["dynamic"]:
+                L.verbose3("%s: names cannot be decided statically", path)
+                return None
+            if public_only and summary["all"] is not None:
+                return set(summary["all"])
+            names = set(summary["names"])
+            for level, module in summary["stars"]:
+                target = self._locate(path, level, module)
+                if target is None:
+                    return None
+                star_names = self.names(target, public_only=True)
+                if star_names is None:
+                    return None
+                names.update(star_names)
+            if public_only:
+                names = {x for x in names if not x.startswith("_")}
+            return names
+        finally:
+            self._visiting.discard(path)
+
+    def _locate(self, path: pathlib.Path, level: int, module: str) -> T.Optional[pathlib.Path]:
+        base = path.parent
+        for _ in range(level - 1):
+            base = base.parent
+        if module:
+            target = base.joinpath(*module.split("."))
+            candidates = [target.with_suffix(".py"), target.joinpath("__init__.py")]
+        else:
+            candidates = [base.joinpath("__init__.py")]
+        for candidate in candidates:
+            if candidate.is_file():
+                return candidate
+        return None
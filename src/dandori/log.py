@@ -83,12 +83,18 @@ class Logger:
             self._logger._log(VERBOSE3, msg, args, **kwargs)  # pylint: disable=protected-access
 
 
+_LOGGERS: dict[str, Logger] = {}
+
+
 def get_logger(name: T.Optional[str] = None):
-    """Return logger"""
-    _init_root_logger()
+    """Return logger, the wrapper is shared by the same name"""
     if name is None:
         name = "dandori"
-    return Logger(name)
+    logger = _LOGGERS.get(name)
+    if logger is None:
+        _init_root_logger()
+        logger = _LOGGERS.setdefault(name, Logger(name))
+    return logger
 
 
 def get_level() -> int:
@@ -1,9 +1,18 @@
+from __future__ import annotations
+
+import functools
+import hashlib
 import os
+import pathlib
+import shutil
 import subprocess as sp
+import sys
+import typing as T
 
 import ruamel.yaml
 from box import Box
 
+import dandori.cache
 import dandori.env
 import dandori.exception
 import dandori.log
@@ -22,7 +31,48 @@ class Operation:
         raise dandori.exception.Cancel(message)
 
     def run(self, args, secret=False, **kwargs):
-        """subprocess wrapper"""
+        """subprocess wrapper
+
+        Output is echoed and captured as stdout. Pass `capture="tail:<bytes>"`, `"file:<path>"` or `"discard"`
+        to keep memory usage constant for huge output (see dandori.process.run)
+        """
+        kwargs = self._run_kwargs(args, secret, kwargs)
+        try:
+            return dandori.process.run(args, **kwargs)
+        except sp.CalledProcessError as e:
+            L.error("Finished with code=%d: %s", e.returncode, args)
+            raise
+
+    async def arun(self, args, secret=False, **kwargs):
+        """Awaitable version of run, to run commands concurrently with asyncio"""
+        kwargs = self._run_kwargs(args, secret, kwargs)
+        try:
+            return await dandori.process.arun(args, **kwargs)
+        except sp.CalledProcessError as e:
+            L.error("Finished with code=%d: %s", e.returncode, args)
+            raise
+
+    def run_many(self, commands, max_parallel: T.Optional[int] = None, secret=False, **kwargs):
+        """Run commands concurrently and return list of CompletedProcess in the same order
+
+        Output of each command is captured separately and printed when the command finished.
+        At most max_parallel (default: number of CPUs) processes run at the same time.
+        With check (default: True), CalledProcessError of the first failed command is raised at once,
+        and the other commands are cancelled and their processes are killed (see dandori.process.run_many).
+        """
+        commands = list(commands)
+        kwargs = self._run_kwargs(commands, secret, kwargs)
+        try:
+            results = dandori.process.run_many(commands, max_parallel=max_parallel, **kwargs)
+        except sp.CalledProcessError as e:
+            L.error("Finished with code=%d: %s", e.returncode, e.cmd)
+            raise
+        for result in results:
+            if result.returncode != 0:
+                L.error("Finished with code=%d: %s", result.returncode, result.args)
+        return results
+
+    def _run_kwargs(self, args, secret: bool, kwargs: dict) -> dict:
         if "encoding" not in kwargs:
             kwargs["encoding"] = "utf-8"
         kwargs.setdefault("check", True)
@@ -32,17 +82,22 @@ class Operation:
         kwargs["env"] = env
         if not secret and dandori.log.get_levelname() == "DEBUG":
             kwargs["echo"] = True
-        try:
-            if not secret:
-                L.verbose3("Execute: %s", args)
-            return dandori.process.run(args, **kwargs)
-        except sp.CalledProcessError as e:
-            L.error("Finished with code=%d: %s", e.returncode, args)
-            raise
+        if not secret:
+            L.verbose3("Execute: %s", args)
+        return kwargs
 
-    def run_venv(self, *args, python_path="python", name="venv", **kwargs):
-        """Run command with virtualenv"""
-        env = self._prepare_venv(python_path, name)
+    def run_venv(self, *args, python_path="python", name="venv", requirements=None, **kwargs):
+        """Run command with virtualenv
+
+        Without requirements, the virtualenv is created in the temporary directory of this run.
+        With requirements (list of requirement specifiers, or path of requirements file), the virtualenv
+        with them installed is cached in `~/.cache/dandori/venvs` and reused across runs. Do not install
+        other packages into it, because it is shared with other runs.
+        """
+        if requirements is None:
+            env = self._prepare_venv(python_path, name)
+        else:
+            env = self._prepare_cached_venv(python_path, name, requirements)
         kwargs.setdefault("env", {}).update(env)
         return self.run(*args, **kwargs)
 
@@ -69,12 +124,72 @@ class Operation:
 
     def _prepare_venv(self, python_path, name):
         venv_dir = dandori.env.tempdir() / name
-        env = {
-            "VIRTUAL_ENV": str(venv_dir),
-            "PATH": f"{venv_dir}/bin:{os.environ['PATH']}",
-        }
         if not venv_dir.exists():
             self.run([python_path, "-m", "venv", "--clear", "--symlinks", str(venv_dir)])
         if not venv_dir.exists():
             raise dandori.exception.Failure(f"Virtualenv directory does not exist: {venv_dir}")
-        return env
+        return self._venv_env(venv_dir)
+
+    def install_site(self, requirements, name="site") -> pathlib.Path:
+        """Install requirements for the running interpreter into a cached directory and return it
+
+        The directory is keyed by the interpreter and the requirements, and reused across runs.
+        Add it to sys.path to import the packages.
+
+        Args:
+            requirements: list of requirement specifiers, or path of requirements file
+            name (str): prefix of the cache directory name
+        """
+        install_args, digest = _requirements(sys.executable, requirements)
+
+        def build(site_dir: pathlib.Path):
+            if not install_args:
+                return
+            self.run([sys.executable, "-m", "pip", "install", "--target", str(site_dir), *install_args])
+
+        sites = dandori.cache.shared(dandori.env.cachedir().joinpath("site"), dandori.env.cache_max_bytes("site", 1024))
+        return sites.get(f"{name}-{digest}", build)
+
+    def _prepare_cached_venv(self, python_path, name, requirements):
+        install_args, digest = _requirements(python_path, requirements)
+
+        def build(venv_dir: pathlib.Path):
+            self.run([python_path, "-m", "venv", "--clear", "--symlinks", str(venv_dir)])
+            if install_args:
+                self.run([str(venv_dir / "bin" / "python"), "-m", "pip", "install", *install_args])
+
+        venvs = dandori.cache.shared(
+            dandori.env.cachedir().joinpath("venvs"), dandori.env.cache_max_bytes("venv", 2048)
+        )
+        return self._venv_env(venvs.get(f"{name}-{digest}", build))
+
+    def _venv_env(self, venv_dir: pathlib.Path) -> dict[str, str]:
+        return {
+            "VIRTUAL_ENV": str(venv_dir),
+            "PATH": f"{venv_dir}/bin:{os.environ['PATH']}",
+        }
+
+
+def _requirements(python_path: str, requirements) -> tuple[list[str], str]:
+    """Return pip install arguments and hash of the requirements for the interpreter"""
+    if isinstance(requirements, (str, pathlib.Path)):
+        path = pathlib.Path(requirements).resolve()
+        spec = path.read_bytes()
+        install_args = ["-r", str(path)]
+    else:
+        install_args = [str(x) for x in requirements]
+        spec = "\n".join(install_args).encode("utf-8")
+    digest = hashlib.sha256(_interpreter_id(python_path).encode("utf-8") + b"\0" + spec).hexdigest()[:16]
+    return install_args, digest
+
+
+@functools.lru_cache(maxsize=None)
+def _interpreter_id(python_path: str) -> str:
+    """Path and version of the interpreter, a cached virtualenv is valid only for the same interpreter"""
+    path = shutil.which(python_path) or python_path
+    if pathlib.Path(path).resolve() == pathlib.Path(sys.executable).resolve():
+        version = sys.version
+    else:
+        r = dandori.process.run([path, "-c", "import sys; print(sys.version)"], echo=False, check=True)
+        version = r.stdout.strip()
+    return f"{pathlib.Path(path).resolve()}\n{version}"
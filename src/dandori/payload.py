@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import typing as T
+
+
+def wrap(value):
+    """Wrap dict/list by payload views, other values are returned as is"""
+    if isinstance(value, (Payload, PayloadList)):
+        return value
+    elif isinstance(value, dict):
+        return Payload(value)
+    elif isinstance(value, list):
+        return PayloadList(value)
+    return value
+
+
+class Payload(dict):
+    """Event payload
+
+    A dict whose nested dicts and lists are wrapped when accessed, so a large payload is never converted deeply.
+    Wrapped values are stored back, so changes of nested values are kept.
+    Values can be accessed by both `payload["key"]` and `payload.key`.
+    """
+
+    def __init__(self, data: T.Optional[dict] = None):
+        """data: parsed json object"""
+        super().__init__({} if data is None else data)
+
+    def __getitem__(self, key):
+        """Get wrapped value"""
+        value = super().__getitem__(key)
+        wrapped = wrap(value)
+        if wrapped is not value:
+            super().__setitem__(key, wrapped)
+        return wrapped
+
+    def __getattr__(self, name):
+        """Same as __getitem__"""
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def get(self, key, default=None):
+        """Get wrapped value or default"""
+        return self[key] if key in self else default
+
+    def values(self):
+        """Wrapped values"""
+        return [self[k] for k in self]
+
+    def items(self):
+        """Keys and wrapped values"""
+        return [(k, self[k]) for k in self]
+
+    def __repr__(self):
+        """repr of data"""
+        return f"<Payload: {super().__repr__()}>"
+
+    def to_dict(self) -> dict:
+        """Return data as a plain dict"""
+        return dict(self)
+
+
+class PayloadList(list):
+    """List in event payload, whose nested dicts and lists are wrapped when accessed"""
+
+    def __getitem__(self, index):
+        """Get wrapped value"""
+        if isinstance(index, slice):
+            return PayloadList(super().__getitem__(index))
+        value = super().__getitem__(index)
+        wrapped = wrap(value)
+        if wrapped is not value:
+            super().__setitem__(index, wrapped)
+        return wrapped
+
+    def __iter__(self):
+        """Iterate wrapped values"""
+        return (self[i] for i in range(len(self)))
+
+    def __repr__(self):
+        """repr of data"""
+        return f"<PayloadList: {super().__repr__()}>"
+
+    def to_list(self) -> list:
+        """Return data as a plain list"""
+        return list(self)
@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+import time
+import typing as T
+
+import dandori.exception
+import dandori.log
+
+L = dandori.log.get_logger(__name__)
+
+V = T.TypeVar("V")
+
+
+def poll(
+    fetch: T.Callable[[], V],
+    done: T.Callable[[V], bool],
+    timeout: float,
+    interval: float = 2.0,
+    max_interval: float = 30.0,
+    factor: float = 1.5,
+) -> V:
+    """Call fetch until done(value) is True and return the value
+
+    The interval grows by factor up to max_interval. Use with GitHub API GET requests,
+    which are conditional requests and unchanged responses (304) do not count against the rate limit.
+
+    Args:
+        fetch: function to get current state
+        done: function to decide the state is the target
+        timeout (float): overall deadline in seconds
+        interval (float): first interval in seconds
+        max_interval (float): max interval in seconds
+        factor (float): backoff factor of interval
+
+    Raises:
+        dandori.exception.Timeout: the state did not reach the target before the deadline
+    """
+    deadline = time.monotonic() + timeout
+    attempt = 0
+    while True:
+        attempt += 1
+        value = fetch()
+        if done(value):
+            return value
+        rest = deadline - time.monotonic()
+        if rest <= 0:
+            raise dandori.exception.Timeout(f"Timed out after {timeout:g} seconds ({attempt} polls)")
+        L.debug("poll: not done yet, wait %.1f seconds", min(interval, rest))
+        time.sleep(min(interval, rest))
+        interval = min(max_interval, interval * factor)
@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import typing as T
+
+from box import Box
+
+import dandori.log
+
+L = dandori.log.get_logger(__name__)
+
+QUERY = """
+query($owner: String!, $name: String!, $number: Int!) {
+  repository(owner: $owner, name: $name) {
+    pullRequest(number: $number) {
+      number title body state merged isDraft mergeable url
+      author { login }
+      mergeCommit { oid }
+      potentialMergeCommit { oid }
+      headRefName headRefOid baseRefName baseRefOid
+      headRepository { nameWithOwner }
+      baseRepository { nameWithOwner }
+      labels(first: 100) { nodes { name color } }
+      commits(last: 1) {
+        nodes {
+          commit {
+            oid
+            checkSuites(first: 50) {
+              pageInfo { hasNextPage }
+              nodes {
+                checkRuns(first: 100, filterBy: {checkType: LATEST}) {
+                  pageInfo { hasNextPage }
+                  nodes { databaseId name status conclusion startedAt completedAt detailsUrl permalink }
+                }
+              }
+            }
+          }
+        }
+      }
+    }
+    refs(refPrefix: "refs/tags/", first: 100, orderBy: {field: TAG_COMMIT_DATE, direction: DESC}) {
+      totalCount
+      nodes { name }
+    }
+    latestRelease { tagName }
+  }
+}
+"""
+
+
+class Snapshot:
+    def __init__(self, repository: dict):
+        """Pull request context fetched by one GraphQL query, converted into REST API shape"""
+        pr = repository["pullRequest"]
+        self.pull_request = self._convert_pull_request(pr)
+        self.head_sha: str = pr["headRefOid"]
+        self.check_runs: list[Box] = []
+        self.check_runs_complete = True
+        for commit in pr["commits"]["nodes"]:
+            suites = commit["commit"]["checkSuites"]
+            if suites["pageInfo"]["hasNextPage"]:
+                self.check_runs_complete = False
+            for suite in suites["nodes"]:
+                if suite["checkRuns"]["pageInfo"]["hasNextPage"]:
+                    self.check_runs_complete = False
+                for run in suite["checkRuns"]["nodes"]:
+                    self.check_runs.append(self._convert_check_run(run, commit["commit"]["oid"]))
+        refs = repository["refs"]
+        self.tags = {x["name"] for x in refs["nodes"]}
+        self.tags_complete = refs["totalCount"] <= len(refs["nodes"])
+        self.latest_release_tag: str = (repository.get("latestRelease") or {}).get("tagName", "")
+
+    def _convert_pull_request(self, pr: dict) -> Box:
+        merge_commit = pr.get("mergeCommit") or pr.get("potentialMergeCommit") or {}
+        return Box(
+            number=pr["number"],
+            title=pr["title"],
+            body=pr["body"],
+            state="open" if pr["state"] == "OPEN" else "closed",
+            merged=pr["merged"],
+            draft=pr["isDraft"],
+            mergeable={"MERGEABLE": True, "CONFLICTING": False}.get(pr["mergeable"]),
+            html_url=pr["url"],
+            user={"login": (pr.get("author") or {}).get("login")},
+            merge_commit_sha=merge_commit.get("oid"),
+            head={
+                "ref": pr["headRefName"],
+                "sha": pr["headRefOid"],
+                "repo": {"full_name": (pr.get("headRepository") or {}).get("nameWithOwner")},
+            },
+            base={
+                "ref": pr["baseRefName"],
+                "sha": pr["baseRefOid"],
+                "repo": {"full_name": (pr.get("baseRepository") or {}).get("nameWithOwner")},
+            },
+            labels=[{"name": x["name"], "color": x["color"]} for x in pr["labels"]["nodes"]],
+        )
+
+    def _convert_check_run(self, run: dict, sha: str) -> Box:
+        return Box(
+            id=run["databaseId"],
+            name=run["name"],
+            head_sha=sha,
+            status=run["status"].lower(),
+            conclusion=run["conclusion"].lower() if run["conclusion"] else None,
+            started_at=run["startedAt"],
+            completed_at=run["completedAt"],
+            details_url=run["detailsUrl"],
+            html_url=run["permalink"],
+        )
+
+
+def fetch(api, owner: str, name: str, number: int) -> T.Optional[Snapshot]:
+    """Fetch pull request, labels, head check runs, tags and latest release in one GraphQL query
+
+    Return None if failed
+    """
+    try:
+        variables = {"owner": owner, "name": name, "number": number}
+        r = api("/graphql", "POST", data={"query": QUERY, "variables": variables})
+    except Exception as e:  # pylint: disable=broad-except
+        L.warning("Failed to prefetch pull request #%s: %s", number, e)
+        return None
+    if r.get("errors") or not ((r.get("data") or {}).get("repository") or {}).get("pullRequest"):
+        L.warning("Failed to prefetch pull request #%s: %s", number, r.get("errors"))
+        return None
+    return Snapshot(r["data"]["repository"])
@@ -8,83 +8,359 @@ http://opensource.org/licenses/mit-license.php
 from __future__ import annotations
 
 import asyncio
+import codecs
+import collections
+import dataclasses
+import os
+import pathlib
 import subprocess as sp
+import sys
+import threading
+import time
 import typing as T
 
+import dandori.stats
+
 STREAM_LIMIT = 2 ** 23  # 8MB instead of default 64kb, override it if you need
+CHUNK_SIZE = 2 ** 16  # bytes read from a pipe at once
+DEFAULT_TAIL_BYTES = 2 ** 20
 
 
-async def _read_stream(stream, outlist, echo, encoding):
-    while True:
-        line = await stream.readline()
-        if line:
-            if encoding is not None:
-                line = line.decode(encoding)
-            outlist.append(line)
-            if echo:
-                print(line, end="")
+class Capture:
+    """Where to keep output of a process. Subclass it to make a custom policy"""
+
+    def write(self, data: bytes):
+        """Receive a chunk of output"""
+        raise NotImplementedError
+
+    def close(self):
+        """Called when the process finished"""
+
+    def getvalue(self) -> bytes:
+        """Captured output"""
+        return b""
+
+
+class FullCapture(Capture):
+    """Keep all output in memory"""
+
+    def __init__(self):
+        """Capture everything"""
+        self._chunks: list[bytes] = []
+
+    def write(self, data: bytes):
+        """Append the chunk"""
+        self._chunks.append(data)
+
+    def getvalue(self) -> bytes:
+        """All output"""
+        return b"".join(self._chunks)
+
+
+class TailCapture(Capture):
+    """Keep last max_bytes of output"""
+
+    def __init__(self, max_bytes: int = DEFAULT_TAIL_BYTES):
+        """max_bytes: size of ring buffer"""
+        self.max_bytes = max_bytes
+        self._chunks: collections.deque[bytes] = collections.deque()
+        self._size = 0
+
+    def write(self, data: bytes):
+        """Append the chunk and drop old chunks out of the buffer"""
+        self._chunks.append(data)
+        self._size += len(data)
+        while len(self._chunks) > 1 and self._size - len(self._chunks[0]) >= self.max_bytes:
+            self._size -= len(self._chunks.popleft())
+
+    def getvalue(self) -> bytes:
+        """Last max_bytes of output"""
+        return b"".join(self._chunks)[-self.max_bytes :] if self.max_bytes else b""
+
+
+class FileCapture(Capture):
+    """Write output into a file, nothing is kept in memory"""
+
+    def __init__(self, path: T.Union[str, pathlib.Path]):
+        """path: output file, truncated at first write"""
+        self.path = pathlib.Path(path)
+        self._fo: T.Optional[T.BinaryIO] = None
+
+    def write(self, data: bytes):
+        """Write the chunk into the file"""
+        if self._fo is None:
+            self._fo = self.path.open("wb")
+        self._fo.write(data)
+
+    def close(self):
+        """Close the file"""
+        if self._fo is None:
+            self.path.touch()
         else:
+            self._fo.close()
+            self._fo = None
+
+
+class DiscardCapture(Capture):
+    """Drop all output"""
+
+    def write(self, data: bytes):
+        """Do nothing"""
+
+
+def make_capture(policy: T.Union[str, Capture, None]) -> Capture:
+    """Create Capture from policy: full, tail[:<bytes>], file:<path>, discard or Capture instance"""
+    if isinstance(policy, Capture):
+        return policy
+    name, _, arg = (policy or "full").partition(":")
+    if name == "full":
+        return FullCapture()
+    elif name == "tail":
+        return TailCapture(int(arg) if arg else DEFAULT_TAIL_BYTES)
+    elif name == "file" and arg:
+        return FileCapture(arg)
+    elif name == "discard":
+        return DiscardCapture()
+    raise ValueError(f"Unknown capture policy: {policy}")
+
+
+async def _read_stream(stream, capture: Capture, echo, encoding):
+    decoder = codecs.getincrementaldecoder(encoding or "utf-8")(errors="replace") if echo else None
+    while True:
+        chunk = await stream.read(CHUNK_SIZE)
+        if not chunk:
             break
+        capture.write(chunk)
+        if decoder is not None:
+            print(decoder.decode(chunk), end="")
+    if decoder is not None:
+        print(decoder.decode(b"", final=True), end="")
+
+
+@dataclasses.dataclass
+class ResourceUsage:
+    wall: float = 0.0  # elapsed seconds
+    user: float = 0.0  # user CPU seconds of the process and its children
+    system: float = 0.0  # system CPU seconds of the process and its children
+    max_rss: int = 0  # peak resident set size in bytes, 0 if unknown
+
+
+class UsageLog:
+    def __init__(self):
+        """Thread safe records of resource usage of commands, grouped by current handler"""
+        self._lock = threading.Lock()
+        self._records: list[tuple[str, T.Any, ResourceUsage]] = []
+
+    def add(self, args, usage: ResourceUsage):
+        """Record usage of the command"""
+        with self._lock:
+            self._records.append((dandori.stats.current_handler(), args, usage))
+
+    def get(self, handler: T.Optional[str] = None) -> list[tuple[T.Any, ResourceUsage]]:
+        """Return (args, usage) of the handler, or all records if handler is None"""
+        with self._lock:
+            return [(args, usage) for name, args, usage in self._records if handler is None or name == handler]
+
+    def handlers(self) -> list[str]:
+        """Handler names which have records"""
+        with self._lock:
+            return list(dict.fromkeys(name for name, _, _ in self._records))
+
+    def reset(self):
+        """Clear all records"""
+        with self._lock:
+            self._records.clear()
+
+
+USAGE = UsageLog()
 
 
-async def _feed_stdin(stdin, ipt):
-    stdin.write(ipt)
+def _in_thread(func, *args) -> asyncio.Future:
+    """Run blocking func in a dedicated thread, which does not occupy the default executor"""
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+
+    def set_exception(err: BaseException):
+        if not future.done():
+            future.set_exception(err)
+
+    def set_result(result):
+        if not future.done():
+            future.set_result(result)
+
+    def target():
+        try:
+            result = func(*args)
+        except BaseException as exc:  # pylint: disable=broad-except
+            loop.call_soon_threadsafe(set_exception, exc)  # pass the exception now, `exc` is unbound after except
+        else:
+            loop.call_soon_threadsafe(set_result, result)
+
+    threading.Thread(target=target, daemon=True).start()
+    return future
+
+
+def _feed_stdin(stdin, ipt: bytes):
     try:
-        await stdin.drain()
+        stdin.write(ipt)
+    except BrokenPipeError:
+        pass
     finally:
-        stdin.close()
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def _wait(popen: sp.Popen) -> tuple[int, T.Optional[T.Any]]:
+    """Wait the process and return (returncode, rusage), rusage is None if wait4 is not supported"""
+    if not hasattr(os, "wait4"):
+        return popen.wait(), None
+    _, status, rusage = os.wait4(popen.pid, 0)
+    popen.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, "waitstatus_to_exitcode") else _exitcode(status)
+    return popen.returncode, rusage
 
 
-async def _stream_subprocess(args, echo=True, **kwargs) -> sp.CompletedProcess:
+def _exitcode(status: int) -> int:
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _usage(wall: float, rusage) -> ResourceUsage:
+    if rusage is None:
+        return ResourceUsage(wall=wall)
+    max_rss = rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss * 1024  # KB on Linux
+    return ResourceUsage(wall=wall, user=rusage.ru_utime, system=rusage.ru_stime, max_rss=max_rss)
+
+
+async def _stream_subprocess(args, echo=True, capture=None, **kwargs) -> sp.CompletedProcess:
     kwargs.pop("stdout", None)
     kwargs.pop("stderr", None)
-    kwargs.setdefault("limit", STREAM_LIMIT)
-    kwargs["stdout"] = asyncio.subprocess.PIPE
-    kwargs["stderr"] = asyncio.subprocess.STDOUT
+    limit = kwargs.pop("limit", STREAM_LIMIT)
     encoding = kwargs.pop("encoding", "utf-8")
     input_str = kwargs.pop("input", None)
     if input_str:
-        kwargs["stdin"] = asyncio.subprocess.PIPE
-    if kwargs.get("shell", False):
-        proc = await asyncio.create_subprocess_shell(args, **kwargs)
-    else:
-        proc = await asyncio.create_subprocess_exec(*args, **kwargs)
-
+        kwargs["stdin"] = sp.PIPE
+    loop = asyncio.get_event_loop()
+    started = time.monotonic()
+    popen = sp.Popen(args, stdout=sp.PIPE, stderr=sp.STDOUT, **kwargs)
+    transport = None
     try:
-        loop = asyncio.get_event_loop()
+        reader = asyncio.StreamReader(limit=limit)
+        transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), popen.stdout)
+        waiter = _in_thread(_wait, popen)
         tasks = []
         if input_str:
             if isinstance(input_str, str):
                 input_str = input_str.encode("utf-8")
-            tasks.append(loop.create_task(_feed_stdin(proc.stdin, input_str)))
-        out: list[str] = []
-        tasks.append(loop.create_task(_read_stream(proc.stdout, out, echo, encoding)))
-        await asyncio.wait(tasks)
+            tasks.append(_in_thread(_feed_stdin, popen.stdin, input_str))
+        capture = make_capture(capture)
+        try:
+            tasks.append(loop.create_task(_read_stream(reader, capture, echo, encoding)))
+            await asyncio.wait(tasks)
+            for task in tasks:
+                task.result()  # raise error of reading output or feeding stdin
+        finally:
+            capture.close()
 
-        output = ""
-        if out:
-            output = "".join(out)
+        content = capture.getvalue()
+        output: T.Union[str, bytes] = content if encoding is None else content.decode(encoding, errors="replace")
 
-        return sp.CompletedProcess(
+        returncode, rusage = await waiter
+        usage = _usage(time.monotonic() - started, rusage)
+        USAGE.add(args, usage)
+        result = sp.CompletedProcess(
             args=args,
-            returncode=await proc.wait(),
+            returncode=returncode,
             stdout=output,
             stderr="",
         )
+        result.usage = usage  # type: ignore
+        return result
     except BaseException:
-        proc.kill()
+        if popen.returncode is None:
+            popen.kill()
         raise
+    finally:
+        if transport is not None:
+            transport.close()
 
 
 def run(args: T.Union[str, list[str]], echo=True, **kwargs) -> sp.CompletedProcess:
     """Always capture
 
     echo(default: True) <- print to stdout or not
+    capture(default: "full") <- what to keep as stdout. "full", "tail[:<bytes>]" (last 1MB by default),
+        "file:<path>" (write to the file, stdout is empty), "discard" or a Capture instance
     """
-    check = kwargs.pop("check", False)
+    return _run_until_complete(arun(args, echo=echo, **kwargs))
 
-    loop = asyncio.get_event_loop()
-    result = loop.run_until_complete(_stream_subprocess(args, echo=echo, **kwargs))
+
+async def arun(args: T.Union[str, list[str]], echo=True, **kwargs) -> sp.CompletedProcess:
+    """Awaitable version of run"""
+    check = kwargs.pop("check", False)
+    result = await _stream_subprocess(args, echo=echo, **kwargs)
     if check and result.returncode != 0:
         raise sp.CalledProcessError(result.returncode, args, output=result.stdout, stderr=result.stderr)
     return result
+
+
+def run_many(commands: T.Iterable[T.Union[str, list[str]]], max_parallel: T.Optional[int] = None, echo=True, **kwargs):
+    """Run commands concurrently and return CompletedProcess of each command in the same order
+
+    max_parallel(default: number of CPUs) <- max number of processes at the same time
+    echo(default: True) <- print output of each command at once when it finished, not to be interleaved
+    check(default: False) <- raise CalledProcessError of the first failed command
+
+    When a command fails, the other commands are cancelled and their processes are killed.
+    """
+    return _run_until_complete(arun_many(commands, max_parallel=max_parallel, echo=echo, **kwargs))
+
+
+async def arun_many(
+    commands: T.Iterable[T.Union[str, list[str]]], max_parallel: T.Optional[int] = None, echo=True, **kwargs
+) -> list[sp.CompletedProcess]:
+    """Awaitable version of run_many"""
+    check = kwargs.pop("check", False)
+    semaphore = asyncio.Semaphore(max_parallel or os.cpu_count() or 1)
+
+    async def run_one(args):
+        async with semaphore:
+            result = await arun(args, echo=False, **kwargs)
+        if echo:
+            cmdline = args if isinstance(args, str) else " ".join(str(x) for x in args)
+            stdout = result.stdout if isinstance(result.stdout, str) else result.stdout.decode(errors="replace")
+            print(f"$ {cmdline}\n{stdout}", end="" if stdout.endswith("\n") or not stdout else "\n")
+        if check and result.returncode != 0:
+            raise sp.CalledProcessError(result.returncode, result.args, output=result.stdout, stderr=result.stderr)
+        return result
+
+    tasks = [asyncio.ensure_future(run_one(args)) for args in commands]
+    if not tasks:
+        return []
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        pending = [x for x in tasks if not x.done()]
+        for task in pending:
+            task.cancel()  # _stream_subprocess kills the process
+        if pending:
+            await asyncio.wait(pending)
+    for task in tasks:
+        error = None if task.cancelled() else task.exception()
+        if error is not None:
+            raise error
+    return [task.result() for task in tasks]
+
+
+def _run_until_complete(coro):
+    """Run coro in a new event loop closed at the end, handlers may call run() from worker threads"""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        try:
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            loop.close()
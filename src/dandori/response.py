@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import threading
+
 
 class Response(dict):
     """Manage running i/o"""
@@ -9,10 +11,12 @@ class Responses:
     def __init__(self):
         """Response of user defined function"""
         self._responses = []
+        self._lock = threading.Lock()  # handlers may run concurrently
 
     def append(self, name: str, resp: Response):
         """append last called response"""
-        self._responses.append({"name": name, "response": resp})
+        with self._lock:
+            self._responses.append({"name": name, "response": resp})
 
     def append_dict(self, name: str, resp: dict):
         """append last called response (dict format)"""
@@ -20,11 +24,18 @@ class Responses:
 
     def get(self, name=None):
         """Get last called function response"""
-        if not self._responses:
+        with self._lock:
+            responses = list(self._responses)
+        if not responses:
             return None
         if name is None:
-            return self._responses[-1]["response"]
-        for resp in self._responses:
+            return responses[-1]["response"]
+        for resp in responses:
             if resp["name"] == name:
                 return resp["response"]
         raise ValueError(f"Response {name} not found")
+
+    def to_list(self) -> list[dict]:
+        """All responses as [{"name": handler name, "response": response}, ...]"""
+        with self._lock:
+            return [dict(x) for x in self._responses]
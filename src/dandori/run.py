@@ -1,16 +1,25 @@
 from __future__ import annotations
 
+import _imp
+import concurrent.futures
 import contextlib
+import hashlib
 import importlib.machinery
+import importlib.util
+import marshal
+import os
+import pathlib
 import sys
+import threading
+import time
 import typing as T
 
 from box import Box
 
 import dandori.response
 
-from . import env, exception, log
-from .config import ConfigLoader
+from . import cache, config, env, exception, log, process, startup, stats
+from .config import ConfigLoader, Handler
 from .context import Context
 from .gh import GitHub, GitHubMock
 from .ops import Operation
@@ -18,6 +27,48 @@ from .ops import Operation
 L = log.get_logger(__name__)
 
 
+class HandlerSourceLoader(importlib.machinery.SourceFileLoader):
+    """SourceFileLoader which keeps bytecode in `~/.cache/dandori/bytecode` keyed by source hash
+
+    Handlers are imported from a new temporary directory on each run, so `__pycache__` beside them is always cold.
+    """
+
+    _pruned = False
+    _lock = threading.Lock()
+
+    def get_code(self, fullname):
+        """Load code from the cache, or compile the source and store it"""
+        source_path = self.get_filename(fullname)
+        data = self.get_data(source_path)
+        digest = hashlib.sha256(importlib.util.MAGIC_NUMBER + b"%d\0" % sys.flags.optimize + data).hexdigest()
+        path = env.cachedir().joinpath("bytecode", digest[:2], digest)
+        try:
+            code = marshal.loads(path.read_bytes())
+        except (OSError, ValueError, EOFError, TypeError):
+            code = None
+        if code is not None:
+            L.debug("Bytecode cache hit: %s", fullname)
+            with contextlib.suppress(OSError):
+                os.utime(path)
+            _imp._fix_co_filename(code, source_path)  # pylint: disable=protected-access
+            return code
+        code = self.source_to_code(data, source_path)
+        try:
+            cache.atomic_write(path, marshal.dumps(code))
+            self._prune()
+        except OSError as e:
+            L.debug("Failed to write bytecode cache %s: %s", path, e)
+        return code
+
+    @classmethod
+    def _prune(cls):
+        with cls._lock:
+            if cls._pruned:
+                return
+            cls._pruned = True
+        cache.prune_files(env.cachedir().joinpath("bytecode"), env.cache_max_bytes("bytecode", 100))
+
+
 class HandlerFinder(importlib.machinery.PathFinder):
     @classmethod
     def find_spec(cls, fullname, path=None, target=None):
@@ -27,8 +78,34 @@ class HandlerFinder(importlib.machinery.PathFinder):
             path = [str(env.tempdir())]
             spec = importlib.machinery.PathFinder.find_spec(fullname, path, target)
             return spec
+        parent, _, name = fullname.rpartition(".")
+        if parent == "dandori.handlers":
+            source = config.direct_source(name)
+            if source is not None:
+                return cls._use_cache(cls._direct_spec(fullname, source))
+        if fullname.startswith("dandori.handlers.") and path is not None:
+            return cls._use_cache(importlib.machinery.PathFinder.find_spec(fullname, path, target))
         return None
 
+    @classmethod
+    def _use_cache(cls, spec):
+        """Replace source loader of the spec with HandlerSourceLoader"""
+        if spec is not None and type(spec.loader) is importlib.machinery.SourceFileLoader:  # noqa: E721
+            spec.loader = HandlerSourceLoader(spec.name, spec.origin)
+        return spec
+
+    @classmethod
+    def _direct_spec(cls, fullname: str, source: pathlib.Path):
+        """spec of a handler imported from its source path (deploy_mode=direct)"""
+        if source.is_file():
+            return importlib.util.spec_from_file_location(fullname, source)
+        init = source.joinpath("__init__.py")
+        if init.is_file():
+            return importlib.util.spec_from_file_location(fullname, init, submodule_search_locations=[str(source)])
+        spec = importlib.machinery.ModuleSpec(fullname, None, is_package=True)  # namespace package
+        spec.submodule_search_locations = [str(source)]
+        return spec
+
 
 class Runner:
     """Running some with user configuration"""
@@ -37,58 +114,214 @@ class Runner:
         """Running some user defined function"""
         self._cfg_path = path
         self._options = options
+        self._config: T.Optional[config.Config] = None
+        self._deploy_lock = threading.Lock()
+        self.durations = stats.Samples()  # seconds of handler calls
 
     def execute(self, invoke_function=None):
         """Setup config, execute function"""
         ctx = self._create_context()
-        with self._setup():
+        process.USAGE.reset()  # report commands of this execution only
+        with self.activate():
+
+            try:
+                self._execute(ctx, invoke_function)
+            finally:
+                self._report_api_usage(ctx)
+                self._report_process_usage()
+
+    def _report_api_usage(self, ctx: Context):
+        if not isinstance(ctx.gh, GitHub) or not ctx.gh.api_created:
+            return
+        counters = ctx.gh.api.stats
+        for name in sorted(counters.handlers()):
+            counts = ", ".join(f"{k}={v:g}" for k, v in sorted(counters.get(name).items()))
+            L.verbose1("GitHub API usage of %s: %s", name or "dandori", counts)
+        L.verbose1("GitHub API rate limit: %s", ctx.gh.api.rate_limit)
+
+    def _report_process_usage(self, top: int = 5):
+        """Log the slowest and the most memory consuming commands of each handler, and usage of all commands with -v"""
+
+        def cmdline(args) -> str:
+            return args if isinstance(args, str) else " ".join(str(x) for x in args)
 
-            self._execute(ctx, invoke_function)
+        for name in process.USAGE.handlers():
+            records = process.USAGE.get(name)
+            wall = sum(usage.wall for _, usage in records)
+            L.info("Commands of %s: %d commands, %.1fs", name or "dandori", len(records), wall)
+            L.info("  slowest:")
+            for args, usage in sorted(records, key=lambda x: x[1].wall, reverse=True)[:top]:
+                L.info("    %.1fs: %s", usage.wall, cmdline(args))
+            L.info("  peak memory:")
+            for args, usage in sorted(records, key=lambda x: x[1].max_rss, reverse=True)[:top]:
+                L.info("    %.1fMB: %s", usage.max_rss / 1024 / 1024, cmdline(args))
+            L.verbose1("  all commands:")
+            for args, usage in records:
+                L.verbose1(
+                    "    wall=%.1fs user=%.1fs sys=%.1fs rss=%.1fMB: %s",
+                    usage.wall,
+                    usage.user,
+                    usage.system,
+                    usage.max_rss / 1024 / 1024,
+                    cmdline(args),
+                )
 
     def _execute(self, ctx: Context, invoke_function: T.Optional[str]):
-        # First to deploy packages
-        for handler in ctx.cfg.handlers:
-            handler.deploy()
-        for handler in ctx.cfg.handlers:
-            if invoke_function:
-                func_name = invoke_function
-            else:
-                func_name = f"handle_{ctx.gh.event_name}"
-            func = handler.get_function(func_name)
-            if not func:
-                L.verbose1("%s: function %s not found", handler.name, func_name)
-                continue
-            L.verbose1("%s: execute %s", handler.name, func_name)
-            try:
-                with ctx.gh.check(f"dandori::{func_name}"):
+        if invoke_function:
+            func_name = invoke_function
+        else:
+            func_name = f"handle_{ctx.gh.event_name}"
+        with startup.phase("index handlers"):
+            handlers = self._select_handlers(ctx.cfg.handlers, func_name, ctx.cfg.deploy_workers)
+        if not handlers:
+            L.verbose1("No handler defines %s", func_name)
+            return
+        with startup.phase("deploy handlers"), self._deploy_lock:
+            self._deploy([x for x in handlers if not x.deployed], ctx.cfg.deploy_workers)
+        targets = []
+        with startup.phase("load handlers"):
+            for handler in handlers:
+                func = handler.get_function(func_name)
+                if not func:
+                    L.verbose1("%s: function %s not found", handler.name, func_name)
+                    continue
+                targets.append((handler, func))
+        if startup.PROFILER is not None:
+            startup.PROFILER.stop()  # imports by handlers are not startup
+        if targets and ctx.cfg.checks.mode == "umbrella":
+            with ctx.gh.umbrella_check(f"{ctx.cfg.checks.name}::{func_name}", defer=ctx.cfg.checks.defer):
+                self._execute_targets(ctx, func_name, targets)
+        else:
+            self._execute_targets(ctx, func_name, targets)
+
+    def _execute_targets(self, ctx: Context, func_name: str, targets: list[tuple[Handler, T.Callable]]):
+        if ctx.cfg.max_workers > 1:
+            self._execute_concurrently(ctx, func_name, targets)
+        else:
+            for handler, func in targets:
+                self._execute_handler(ctx, handler, func_name, func)
+
+    def _select_handlers(self, handlers: list[Handler], func_name: str, max_workers: int) -> list[Handler]:
+        """Handlers which may define the function, found by static index without deploy and import"""
+        if not handlers or env.handler_index_disabled():
+            return handlers
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+            matches = list(pool.map(lambda h: h.may_define(func_name), handlers))
+        for handler, match in zip(handlers, matches):
+            if not match:
+                L.verbose1("%s: function %s not found (index)", handler.name, func_name)
+        return [handler for handler, match in zip(handlers, matches) if match]
+
+    def _deploy(self, handlers: list[Handler], max_workers: int):
+        """Deploy handlers in a bounded thread pool and raise all errors at once"""
+        if not handlers:
+            return
+        errors: dict[str, BaseException] = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(handler.deploy): handler for handler in handlers}
+            for future in concurrent.futures.as_completed(futures):
+                handler = futures[future]
+                error = future.exception()
+                if error is not None:
+                    L.error("%s: deploy failed: %s", handler.name, error)
+                    errors[handler.name] = error
+        if errors:
+            raise exception.DeployError(errors)
+
+    def _execute_concurrently(self, ctx: Context, func_name: str, targets: list[tuple[Handler, T.Callable]]):
+        """Run handlers in a thread pool. A handler starts after all handlers in its `after` succeeded"""
+        names = {handler.name for handler, _ in targets}
+        pending = list(targets)
+        running: dict[concurrent.futures.Future, Handler] = {}
+        succeeded: set[str] = set()
+        failed: set[str] = set()
+        errors: list[BaseException] = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=ctx.cfg.max_workers) as pool:
+            while pending or running:
+                for target in list(pending):
+                    handler, func = target
+                    after = [x for x in handler.after if x in names]
+                    if failed.intersection(after):
+                        L.warning("%s: skip %s because a handler in after failed", handler.name, func_name)
+                        failed.add(handler.name)
+                        pending.remove(target)
+                    elif succeeded.issuperset(after):
+                        running[pool.submit(self._execute_handler, ctx, handler, func_name, func)] = handler
+                        pending.remove(target)
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    handler = running.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        succeeded.add(handler.name)
+                    else:
+                        failed.add(handler.name)
+                        errors.append(error)
+                        L.error("%s: %s failed: %s: %s", handler.name, func_name, type(error).__name__, error)
+        if errors:
+            if len(errors) > 1:
+                L.error("%d handlers failed, raise the first error", len(errors))
+            raise errors[0]
+
+    def _execute_handler(self, ctx: Context, handler: Handler, func_name: str, func: T.Callable):
+        L.verbose1("%s: execute %s", handler.name, func_name)
+        r = None
+        try:
+            name = handler.name if ctx.cfg.checks.mode == "umbrella" else f"dandori::{func_name}"
+            with stats.handler_scope(handler.name), ctx.gh.check(name, defer=ctx.cfg.checks.defer):
+                started = time.perf_counter()
+                try:
                     r = func(ctx)
-            except exception.Cancel:
-                ctx.gh.cancel()
-            except Exception as e:
-                print(f"::error::{e}")
-                raise
-            if isinstance(r, dict):
-                ctx.resp.append_dict(handler.name, r)
-            elif isinstance(r, dandori.response.Response):
-                ctx.resp.append(handler.name, r)
-            else:
-                ctx.resp.append_dict(handler.name, {})
+                finally:
+                    self.durations.add(time.perf_counter() - started)
+        except exception.Cancel:
+            ctx.gh.cancel()
+        except Exception as e:
+            print(f"::error::{e}")
+            raise
+        if isinstance(r, dict):
+            ctx.resp.append_dict(handler.name, r)
+        elif isinstance(r, dandori.response.Response):
+            ctx.resp.append(handler.name, r)
+        else:
+            ctx.resp.append_dict(handler.name, {})
+
+    def prepare(self) -> config.Config:
+        """Load configuration once, it is shared by all events dispatched by this runner"""
+        if self._config is None:
+            with startup.phase("load config"):
+                cfg = ConfigLoader().load(self._cfg_path)
+            cfg.options.merge_update(self._options)
+            L.verbose3("Options: %s", cfg.options)
+            self._config = cfg
+        return self._config
+
+    def dispatch(self, gh: T.Union[GitHub, GitHubMock], invoke_function=None) -> dandori.response.Responses:
+        """Execute handlers for an event, must be called inside `activate()`
+
+        Handlers are deployed and imported at the first event which needs them, and reused by later events.
+        """
+        ctx = Context(gh=gh, cfg=self.prepare(), ops=Operation(), resp=dandori.response.Responses())
+        self._execute(ctx, invoke_function)
+        return ctx.resp
 
     def _create_context(self) -> Context:
-        if env.is_local():
-            gh = GitHubMock()
-        else:
-            gh = GitHub()  # type: ignore
-        config = ConfigLoader().load(self._cfg_path)
-        config.options.merge_update(self._options)
-        L.verbose3("Options: %s", config.options)
+        with startup.phase("init GitHub"):
+            if env.is_local():
+                gh = GitHubMock()
+            else:
+                gh = GitHub()  # type: ignore
+        cfg = self.prepare()
         ops = Operation()
         resp = dandori.response.Responses()
-        return Context(gh=gh, cfg=config, ops=ops, resp=resp)
+        return Context(gh=gh, cfg=cfg, ops=ops, resp=resp)
 
     @contextlib.contextmanager
-    def _setup(self):
-        sys.meta_path.append(HandlerFinder)
+    def activate(self):
+        """Make deployed handlers importable as dandori.handlers"""
+        sys.meta_path.insert(0, HandlerFinder)  # before PathFinder to load handler submodules with bytecode cache
         try:
             yield
         finally:
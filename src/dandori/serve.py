@@ -0,0 +1,256 @@
+from __future__ import annotations
+
+import concurrent.futures
+import contextlib
+import hashlib
+import hmac
+import http.server
+import itertools
+import json
+import os
+import pathlib
+import socketserver
+import threading
+import typing as T
+import urllib.parse
+
+import dandori.log
+from dandori import exception, process
+from dandori.gh import GitHub, GitHubMock
+from dandori.run import Runner
+
+L = dandori.log.get_logger(__name__)
+
+# GITHUB_* variables which GitHub requires, filled when an event does not have them
+DEFAULT_ENVIRON = {
+    "GITHUB_EVENT_PATH": "",
+    "GITHUB_REPOSITORY": "",
+    "GITHUB_EVENT_NAME": "",
+    "GITHUB_SHA": "",
+    "GITHUB_REF": "",
+    "GITHUB_WORKFLOW": "",
+    "GITHUB_ACTION": "",
+    "GITHUB_ACTOR": "",
+    "GITHUB_JOB": "",
+    "GITHUB_RUN_NUMBER": "0",
+    "GITHUB_RUN_ID": "0",
+}
+
+
+class QueueFull(exception.DandoriError):
+    """Too many events are waiting"""
+
+
+def webhook_environ(event_name: str, payload: dict) -> dict[str, str]:
+    """GITHUB_* variables of a webhook event, derived from its payload"""
+    pull_request = payload.get("pull_request") or {}
+    sha = (
+        payload.get("after")
+        or (pull_request.get("head") or {}).get("sha")
+        or (payload.get("check_run") or payload.get("check_suite") or {}).get("head_sha")
+        or ""
+    )
+    return {
+        **DEFAULT_ENVIRON,
+        "GITHUB_REPOSITORY": (payload.get("repository") or {}).get("full_name", ""),
+        "GITHUB_EVENT_NAME": event_name,
+        "GITHUB_SHA": sha,
+        "GITHUB_REF": payload.get("ref") or "",
+        "GITHUB_ACTOR": (payload.get("sender") or {}).get("login", ""),
+    }
+
+
+class EventServer:
+    def __init__(self, runner: Runner, workers: int = 4, max_queue: int = 100, dry_run: bool = False):
+        """Dispatch events to handlers in a worker pool, with the configuration and handlers loaded once
+
+        Args:
+            runner (Runner): runner which keeps configuration and deployed handlers
+            workers (int): number of events handled at the same time
+            max_queue (int): max number of waiting and running events
+            dry_run (bool): log API calls instead of calling GitHub API
+        """
+        self._runner = runner
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dandori-event")
+        self._max_queue = max_queue
+        self._dry_run = dry_run
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._apis: dict[str, T.Any] = {}  # repository -> API client shared by events
+
+    @property
+    def pending(self) -> int:
+        """Number of waiting and running events"""
+        return self._pending
+
+    def submit(self, environ: dict[str, str], payload: dict, invoke_function: T.Optional[str] = None):
+        """Queue an event and return (event id, future of responses)"""
+        with self._lock:
+            if self._pending >= self._max_queue:
+                raise QueueFull(f"{self._pending} events are waiting")
+            self._pending += 1
+            event_id = next(self._ids)
+        environ = {**DEFAULT_ENVIRON, **environ}
+        L.verbose1("Event %d queued: %s %s", event_id, environ["GITHUB_EVENT_NAME"], environ["GITHUB_REPOSITORY"])
+        return event_id, self._pool.submit(self._handle, event_id, environ, payload, invoke_function)
+
+    def shutdown(self):
+        """Wait for queued events"""
+        self._pool.shutdown(wait=True)
+
+    def _handle(self, event_id: int, environ: dict[str, str], payload: dict, invoke_function: T.Optional[str]):
+        try:
+            resp = self._runner.dispatch(self._github(environ, payload), invoke_function)
+            L.verbose1("Event %d finished", event_id)
+            return resp.to_list()
+        except Exception as e:
+            L.error("Event %d failed: %s", event_id, e)
+            raise
+        finally:
+            with self._lock:
+                self._pending -= 1
+                if self._pending == 0:
+                    process.USAGE.reset()
+
+    def _github(self, environ: dict[str, str], payload: dict) -> T.Union[GitHub, GitHubMock]:
+        if self._dry_run:
+            return GitHubMock(event_name=environ["GITHUB_EVENT_NAME"])  # API calls are logged
+        repository = environ["GITHUB_REPOSITORY"]
+        if repository.count("/") != 1:
+            raise exception.DandoriError(f"Invalid repository: {repository!r}")
+        with self._lock:
+            api = self._apis.get(repository)
+            if api is None:
+                api = self._apis[repository] = GitHub.create_api(*repository.split("/"))
+        return GitHub(environ=environ, payload=payload, api=api, checkout=False)
+
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+    """HTTP API of EventServer
+
+    POST /webhook: GitHub webhook (X-GitHub-Event header and payload)
+    POST /events: {"environ": {GITHUB_* variables}, "payload": {...}, "invoke": function name (optional)}
+    GET /health: number of pending events
+
+    Events are queued and 202 is returned, or with `?wait=1` the responses of handlers are returned.
+    POST requests must be `application/json` and signed by DANDORI_WEBHOOK_SECRET (X-Hub-Signature-256),
+    which can be unset only for a unix socket.
+    """
+
+    server: T.Any
+
+    def do_GET(self):  # noqa: N802
+        """Health check"""
+        if urllib.parse.urlsplit(self.path).path == "/health":
+            self._reply(200, {"status": "ok", "pending": self.server.events.pending})
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def do_POST(self):  # noqa: N802
+        """Queue an event"""
+        url = urllib.parse.urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.headers.get_content_type() != "application/json":
+            # a form or text/plain POST of a web page to localhost is not accepted
+            self._reply(415, {"error": "Content-Type must be application/json"})
+            return
+        if not self._verify(body):
+            self._reply(401, {"error": "invalid signature"})
+            return
+        try:
+            data = json.loads(body or b"{}")
+            if url.path == "/webhook":
+                event_name = self.headers.get("X-GitHub-Event", "")
+                environ, payload, invoke = webhook_environ(event_name, data), data, None
+            elif url.path == "/events":
+                environ, payload, invoke = data.get("environ", {}), data.get("payload", {}), data.get("invoke")
+            else:
+                self._reply(404, {"error": "not found"})
+                return
+            event_id, future = self.server.events.submit(environ, payload, invoke)
+        except QueueFull as e:
+            self._reply(503, {"error": str(e)})
+            return
+        except (ValueError, AttributeError) as e:
+            self._reply(400, {"error": str(e)})
+            return
+        if urllib.parse.parse_qs(url.query).get("wait", ["0"])[0] in ("0", ""):
+            self._reply(202, {"id": event_id})
+            return
+        try:
+            self._reply(200, {"id": event_id, "responses": future.result()})
+        except Exception as e:  # pylint: disable=broad-except
+            self._reply(500, {"id": event_id, "error": str(e)})
+
+    def address_string(self):
+        """Unix socket has no client address"""
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Log requests by dandori logger"""
+        L.verbose2("%s %s", self.address_string(), format % args)
+
+    def _verify(self, body: bytes) -> bool:
+        secret = os.environ.get("DANDORI_WEBHOOK_SECRET")
+        if not secret:
+            return isinstance(self.server, _UnixServer)  # only the owner of the socket file can connect
+        expected = "sha256=" + hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, self.headers.get("X-Hub-Signature-256", ""))
+
+    def _reply(self, status: int, data: dict):
+        content = json.dumps(data, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class _TCPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(
+    runner: Runner,
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    unix_socket: T.Optional[str] = None,
+    workers: int = 4,
+    max_queue: int = 100,
+    dry_run: bool = False,
+):
+    """Serve events over local HTTP (or HTTP over unix socket) until interrupted
+
+    DANDORI_WEBHOOK_SECRET is required for TCP, because events can run any handler function.
+    """
+    if not unix_socket and not os.environ.get("DANDORI_WEBHOOK_SECRET"):
+        raise exception.DandoriError("Set DANDORI_WEBHOOK_SECRET to serve on TCP, or use --unix-socket")
+    events = EventServer(runner, workers=workers, max_queue=max_queue, dry_run=dry_run)
+    if unix_socket:
+        path = pathlib.Path(unix_socket)
+        if path.is_socket():
+            path.unlink()
+        server: socketserver.BaseServer = _UnixServer(str(path), _RequestHandler)
+        address = f"unix:{path}"
+    else:
+        server = _TCPServer((host, port), _RequestHandler)
+        address = f"http://{host}:{server.server_address[1]}"
+    server.events = events  # type: ignore
+    runner.prepare()
+    with runner.activate():
+        L.info("dandori serves events on %s", address)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            L.info("Shutting down")
+        finally:
+            server.server_close()
+            events.shutdown()
+            if unix_socket:
+                with contextlib.suppress(OSError):
+                    pathlib.Path(unix_socket).unlink()
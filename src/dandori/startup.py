@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import contextlib
+import importlib.abc
+import sys
+import time
+import typing as T
+
+PROFILER: T.Optional[Profiler] = None
+
+
+class _TimingLoader(importlib.abc.Loader):
+    """Loader proxy which measures exec_module time"""
+
+    def __init__(self, loader, profiler: Profiler):
+        self._loader = loader
+        self._profiler = profiler
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        with self._profiler.importing(module.__name__):
+            self._loader.exec_module(module)
+
+
+class _TimingFinder(importlib.abc.MetaPathFinder):
+    def __init__(self, profiler: Profiler):
+        self._profiler = profiler
+
+    def find_spec(self, fullname, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                    spec.loader = _TimingLoader(spec.loader, self._profiler)
+                return spec
+        return None
+
+
+class Profiler:
+    def __init__(self):
+        """Measure time of startup phases and module imports"""
+        self._started = time.perf_counter()
+        self.phases: list[tuple[str, float]] = []
+        self.imports: dict[str, tuple[float, float]] = {}  # name -> (cumulative, self)
+        self._stack: list[list[float]] = []  # [started, children time] of modules being imported
+        self._finder = _TimingFinder(self)
+
+    def start(self):
+        """Start measuring imports"""
+        sys.meta_path.insert(0, self._finder)
+
+    def stop(self):
+        """Stop measuring imports"""
+        if self._finder in sys.meta_path:
+            sys.meta_path.remove(self._finder)
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Measure a phase"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started))
+
+    @contextlib.contextmanager
+    def importing(self, name: str):
+        """Measure import of a module"""
+        frame = [time.perf_counter(), 0.0]
+        self._stack.append(frame)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            elapsed = time.perf_counter() - frame[0]
+            self.imports[name] = (elapsed, elapsed - frame[1])
+            if self._stack:
+                self._stack[-1][1] += elapsed
+
+    def report(self, top: int = 20) -> str:
+        """Return breakdown of phases and the slowest imports"""
+        total = time.perf_counter() - self._started
+        lines = [f"Startup profile: total {total * 1000:.1f} ms", "  phases:"]
+        for name, elapsed in self.phases:
+            lines.append(f"    {elapsed * 1000:9.1f} ms  {name}")
+        lines.append(f"  imports (cumulative / self, top {top}):")
+        for name, (cumulative, self_time) in sorted(self.imports.items(), key=lambda x: -x[1][0])[:top]:
+            lines.append(f"    {cumulative * 1000:9.1f} ms {self_time * 1000:9.1f} ms  {name}")
+        return "\n".join(lines)
+
+
+def enable() -> Profiler:
+    """Start profiling startup of this process"""
+    global PROFILER  # pylint: disable=global-statement
+    if PROFILER is None:
+        PROFILER = Profiler()
+        PROFILER.start()
+    return PROFILER
+
+
+def phase(name: str) -> T.ContextManager:
+    """Measure a phase if profiling is enabled"""
+    if PROFILER is None:
+        return contextlib.nullcontext()
+    return PROFILER.phase(name)
@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import collections
+import contextlib
+import contextvars
+import math
+import threading
+import typing as T
+
+_HANDLER: contextvars.ContextVar[str] = contextvars.ContextVar("dandori_handler", default="")
+
+
+def current_handler() -> str:
+    """Name of the handler running in this context, empty if outside of handlers"""
+    return _HANDLER.get()
+
+
+@contextlib.contextmanager
+def handler_scope(name: str):
+    """Attribute resource usage in this context to the handler"""
+    token = _HANDLER.set(name)
+    try:
+        yield
+    finally:
+        _HANDLER.reset(token)
+
+
+class Counters:
+    def __init__(self):
+        """Thread safe counters grouped by current handler"""
+        self._lock = threading.Lock()
+        self._counts: dict[str, dict[str, float]] = collections.defaultdict(lambda: collections.defaultdict(float))
+
+    def add(self, key: str, value: float = 1):
+        """Add value to the counter of current handler"""
+        with self._lock:
+            self._counts[current_handler()][key] += value
+
+    def get(self, handler: T.Optional[str] = None) -> dict[str, float]:
+        """Return counters of the handler, or total of all handlers if handler is None"""
+        with self._lock:
+            if handler is not None:
+                return dict(self._counts.get(handler, {}))
+            total: dict[str, float] = collections.defaultdict(float)
+            for counts in self._counts.values():
+                for key, value in counts.items():
+                    total[key] += value
+            return dict(total)
+
+    def handlers(self) -> list[str]:
+        """Handler names which have counters"""
+        with self._lock:
+            return list(self._counts)
+
+    def reset(self):
+        """Clear all counters"""
+        with self._lock:
+            self._counts.clear()
+
+
+class Samples:
+    def __init__(self):
+        """Thread safe samples (e.g. durations) grouped by current handler"""
+        self._lock = threading.Lock()
+        self._samples: dict[str, list[float]] = collections.defaultdict(list)
+
+    def add(self, value: float):
+        """Add a sample of current handler"""
+        with self._lock:
+            self._samples[current_handler()].append(value)
+
+    def get(self, handler: str) -> list[float]:
+        """Return samples of the handler"""
+        with self._lock:
+            return list(self._samples.get(handler, []))
+
+    def handlers(self) -> list[str]:
+        """Handler names which have samples"""
+        with self._lock:
+            return list(self._samples)
+
+    def reset(self):
+        """Clear all samples"""
+        with self._lock:
+            self._samples.clear()
+
+
+def percentile(samples: list[float], q: float) -> float:
+    """Return nearest-rank percentile of samples, q is in (0, 100]"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
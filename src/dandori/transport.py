@@ -0,0 +1,507 @@
+from __future__ import annotations
+
+import contextlib
+import dataclasses
+import hashlib
+import http.client
+import io
+import json
+import os
+import pathlib
+import random
+import re
+import shutil
+import threading
+import time
+import typing as T
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from fastcore.utils import dict2obj, urlrequest
+from ghapi.all import GhApi
+
+import dandori.cache
+import dandori.cassette
+import dandori.log
+import dandori.stats
+
+L = dandori.log.get_logger(__name__)
+
+# Seconds to reuse a cached response without asking GitHub. Other endpoints are always revalidated
+# with a conditional request, and 304 responses do not count against the rate limit.
+DEFAULT_TTLS = {
+    "/repos/{owner}/{repo}/releases/latest": 60,
+    "/repos/{owner}/{repo}/labels/{name}": 300,
+}
+
+
+class Headers(dict):
+    """Case insensitive HTTP headers"""
+
+    def __init__(self, *args, **kwargs):
+        """Same as dict"""
+        super().__init__()
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+    def __setitem__(self, key, value):
+        """Set header"""
+        super().__setitem__(key.lower(), value)
+
+    def __getitem__(self, key):
+        """Get header"""
+        return super().__getitem__(key.lower())
+
+    def __contains__(self, key):
+        """Check header exists"""
+        return super().__contains__(key.lower())
+
+    def get(self, key, default=None):
+        """Get header or default"""
+        return super().get(key.lower(), default)
+
+
+IDEMPOTENT_VERBS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+RETRY_STATUS = (500, 502, 503, 504)
+REDIRECT_STATUS = (301, 302, 303, 307, 308)
+USER_AGENT = "dandori"
+# errors on a reused keep-alive connection which the server already closed
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.CannotSendRequest,
+    ConnectionResetError,
+    BrokenPipeError,
+)
+
+
+@dataclasses.dataclass
+class RetryPolicy:
+    max_retries: int = 5
+    backoff: float = 1.0  # base seconds of exponential backoff
+    max_backoff: float = 60.0
+    max_wait: float = 300.0  # give up if rate limit resets later than this
+    throttle_ratio: float = 0.1  # slow down when remaining budget is less than this ratio
+    max_throttle: float = 5.0  # max seconds to wait before a request when throttling
+    sleep: bool = True  # False to retry at once without waiting, e.g. for replayed responses
+
+    def backoff_seconds(self, attempt: int) -> float:
+        """Exponential backoff with jitter"""
+        seconds = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return seconds / 2 + random.uniform(0, seconds / 2)
+
+
+class ConnectionPool:
+    def __init__(self, timeout: float = 60.0):
+        """Keep-alive HTTP(S) connections per thread and host"""
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def request(self, verb: str, url: str, headers: dict[str, str], data: T.Optional[bytes]):
+        """Send a request on a pooled connection and return the response with its content read"""
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        key = (parts.scheme, parts.netloc)
+        while True:
+            conn, reused = self._connection(key)
+            try:
+                conn.request(verb, path, body=data, headers=headers)
+                resp = conn.getresponse()
+                content = resp.read()
+            except STALE_CONNECTION_ERRORS:
+                self._discard(key)
+                if reused:
+                    L.debug("Keep-alive connection closed by server, reconnect: %s", parts.netloc)
+                    continue
+                raise
+            except BaseException:
+                self._discard(key)
+                raise
+            if resp.will_close:
+                self._discard(key)
+            return resp, content
+
+    def close(self):
+        """Close connections of the current thread"""
+        for key in list(self._connections()):
+            self._discard(key)
+
+    def _connections(self) -> dict:
+        if not hasattr(self._local, "connections"):
+            self._local.connections = {}
+        return self._local.connections
+
+    def _connection(self, key: tuple[str, str]) -> tuple[http.client.HTTPConnection, bool]:
+        connections = self._connections()
+        if key in connections:
+            return connections[key], True
+        scheme, netloc = key
+        if scheme == "https":
+            conn: http.client.HTTPConnection = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+        connections[key] = conn
+        return conn, False
+
+    def _discard(self, key: tuple[str, str]):
+        conn = self._connections().pop(key, None)
+        if conn is not None:
+            conn.close()
+
+
+@dataclasses.dataclass
+class CachedResponse:
+    url: str
+    stored_at: float
+    headers: Headers
+    content: bytes
+
+    @property
+    def etag(self) -> T.Optional[str]:
+        """ETag header"""
+        return self.headers.get("ETag")
+
+    @property
+    def last_modified(self) -> T.Optional[str]:
+        """Last-Modified header"""
+        return self.headers.get("Last-Modified")
+
+
+def _template_regex(template: str) -> str:
+    """Regex of an endpoint path template, `{name}` matches a path segment as a named group"""
+    return re.sub(r"\\{([^/]+?)\\}", r"(?P<\1>[^/]+)", re.escape(template))
+
+
+def _format_path(template: str, values: dict[str, str]) -> str:
+    """Fill `{name}` of an endpoint path template"""
+    return re.sub(r"\{([^/]+?)\}", lambda m: values[m.group(1)], template)
+
+
+class ResponseCache:
+    def __init__(self, root: pathlib.Path, max_bytes: int = 0, ttls: T.Optional[dict[str, float]] = None):
+        """On-disk cache of GET responses, revalidated by ETag/Last-Modified
+
+        Responses are stored per auth identity (hash of Authorization header), so a response fetched with a
+        token is never served to another token.
+
+        Args:
+            root (pathlib.Path): cache directory
+            max_bytes (int): size limit of the cache (0 means unlimited)
+            ttls (dict): endpoint path template -> seconds to use a cached response without revalidation
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULT_TTLS if ttls is None else ttls)
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def ttl(self, url: str) -> float:
+        """TTL of the endpoint"""
+        path = urllib.parse.urlparse(url).path
+        for template, ttl in self.ttls.items():
+            if re.fullmatch(_template_regex(template), path):
+                return ttl
+        return 0
+
+    def get(self, url: str, accept: str, identity: str = "") -> T.Optional[CachedResponse]:
+        """Return stored response or None"""
+        path = self._path(url, accept, identity)
+        try:
+            with path.open("rb") as fi:
+                meta = json.loads(fi.readline())
+                content = fi.read()
+        except (OSError, ValueError):
+            return None
+        with contextlib.suppress(OSError):
+            os.utime(path)  # last used time for eviction
+        return CachedResponse(url=url, stored_at=meta["stored_at"], headers=Headers(meta["headers"]), content=content)
+
+    def is_fresh(self, resp: CachedResponse) -> bool:
+        """Return True if the response can be used without revalidation"""
+        return time.time() - resp.stored_at < self.ttl(resp.url)
+
+    def put(self, url: str, accept: str, headers: Headers, content: bytes, identity: str = ""):
+        """Store response if it can be revalidated or has TTL"""
+        if "ETag" not in headers and "Last-Modified" not in headers and not self.ttl(url):
+            return
+        keep = {k: headers[k] for k in ("ETag", "Last-Modified", "Content-Type", "Link") if k in headers}
+        meta = json.dumps({"url": url, "stored_at": time.time(), "headers": keep}).encode("utf-8")
+        dandori.cache.atomic_write(self._path(url, accept, identity), meta + b"\n" + content)
+        with self._lock:
+            self._writes += 1
+            prune = self._writes % 50 == 1
+        if prune:
+            dandori.cache.prune_files(self.root, self.max_bytes)
+
+    def invalidate(self, url: str, identity: str = ""):
+        """Remove responses of GET requests which a write request (POST, PATCH, ...) to the url may change
+
+        They are the response of the url itself and responses with TTL in the same collection,
+        e.g. a write to `/repos/{owner}/{repo}/releases/...` removes `/repos/{owner}/{repo}/releases/latest`.
+        """
+        parts = urllib.parse.urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}"
+        urls = {origin + parts.path}
+        for template in self.ttls:
+            collection, _, last = template.rpartition("/")
+            m = re.fullmatch(_template_regex(collection) + r"(?:/(?P<_next>[^/]+))?(?:/.*)?", parts.path)
+            if m is None:
+                continue
+            values = {k: v for k, v in m.groupdict().items() if k != "_next"}
+            if last.startswith("{"):
+                if m.group("_next") is None:
+                    continue  # the item is not known
+                last = m.group("_next")
+            urls.add(origin + _format_path(collection, values) + "/" + last)
+        for target in urls:
+            L.debug("Invalidate cache: %s", target)
+            shutil.rmtree(self._resource_dir(target, identity), ignore_errors=True)
+
+    def _resource_dir(self, url: str, identity: str) -> pathlib.Path:
+        key = hashlib.sha256(f"{identity}\n{url}".encode("utf-8")).hexdigest()
+        return self.root.joinpath(key[:2], key)
+
+    def _path(self, url: str, accept: str, identity: str) -> pathlib.Path:
+        return self._resource_dir(url, identity).joinpath(hashlib.sha256(accept.encode("utf-8")).hexdigest()[:16])
+
+
+def _resource(url: str) -> str:
+    """Rate limit resource (X-RateLimit-Resource) which the request is counted against"""
+    path = urllib.parse.urlsplit(url).path
+    if path.endswith("/graphql"):
+        return "graphql"
+    if "/search/code" in path:
+        return "code_search"
+    if "/search/" in path:
+        return "search"
+    return "core"
+
+
+def _identity(headers: dict[str, str]) -> str:
+    """Hash of the credential of a request, the credential itself is not stored"""
+    auth = next((v for k, v in headers.items() if k.lower() == "authorization"), "")
+    return hashlib.sha256(auth.encode("utf-8")).hexdigest()[:32] if auth else ""
+
+
+class Client(GhApi):
+    limit_rem: T.Union[int, str]  # remaining rate limit, initialized by GhApi
+
+    def __init__(
+        self,
+        *args,
+        cache: T.Optional[ResponseCache] = None,
+        retry: T.Optional[RetryPolicy] = None,
+        pool: T.Optional[ConnectionPool] = None,
+        cassette: T.Optional[T.Union[dandori.cassette.Recorder, dandori.cassette.Player]] = None,
+        **kwargs,
+    ):
+        """GhApi which sends requests through dandori transport with response cache, retry and throttling
+
+        `stats` counts requests per handler: requests (sent to GitHub), cached (served without request),
+        not_modified (304, not counted by rate limit), retries and throttled (seconds)
+        `cassette` records responses (Recorder) or serves recorded responses without GitHub (Player)
+        """
+        super().__init__(*args, **kwargs)
+        self.cache = cache
+        self.retry = RetryPolicy() if retry is None else retry
+        self.pool = ConnectionPool() if pool is None else pool
+        self.cassette = cassette
+        self.stats = dandori.stats.Counters()
+        # resource (core, graphql, search, ...) -> remaining, limit, reset of the last response
+        self.rate_limit: dict[str, dict[str, int]] = {}
+        self._rate_lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def recv_hdrs(self) -> Headers:
+        """Headers of the last response in the current thread, GhApi reads them for pagination"""
+        if not hasattr(self._local, "recv_hdrs"):
+            self._local.recv_hdrs = Headers()
+        return self._local.recv_hdrs
+
+    @recv_hdrs.setter
+    def recv_hdrs(self, value: Headers):
+        self._local.recv_hdrs = value
+
+    def __call__(
+        self,
+        path: str,
+        verb: T.Optional[str] = None,
+        headers: T.Optional[dict] = None,
+        route: T.Optional[dict] = None,
+        query: T.Optional[dict] = None,
+        data=None,
+    ):
+        """Call a fully specified `path` using HTTP `verb`, same as GhApi.__call__"""
+        if verb is None:
+            verb = "POST" if data else "GET"
+        verb = verb.upper()
+        headers = {**self.headers, **(headers or {})}
+        if not path.startswith(("http://", "https://")):
+            path = self.gh_host + path
+        if route:
+            path = path.format(**{k: urllib.parse.quote(str(v)) for k, v in route.items()})
+        if query:
+            path += "?" + urllib.parse.urlencode(query)
+        data = data or None
+        if isinstance(data, dict):
+            data = json.dumps(data).encode("utf-8")
+        if self.debug:
+            self.debug(urlrequest(path, verb, headers, data=data))  # same hook as GhApi, e.g. ghapi.all.print_summary
+        content, recv_headers = self._request(verb, path, headers, data)
+        self.recv_hdrs = recv_headers
+        if "X-RateLimit-Remaining" in recv_headers:
+            newlim = recv_headers["X-RateLimit-Remaining"]
+            with self._rate_lock:
+                changed, self.limit_rem = newlim != self.limit_rem, newlim
+            if self.limit_cb is not None and changed:
+                self.limit_cb(int(newlim), int(recv_headers["X-RateLimit-Limit"]))
+        if not content:
+            return {}
+        if "json" not in headers.get("Accept", "json"):
+            return content.decode("utf-8")
+        return dict2obj(json.loads(content))
+
+    def _request(self, verb: str, url: str, headers: dict[str, str], data: T.Optional[bytes]) -> tuple[bytes, Headers]:
+        """Send a request through the cache and return (content, response headers)"""
+        accept = headers.get("Accept", "")
+        identity = _identity(headers)
+        cached = None
+        if verb == "GET" and self.cache is not None:
+            cached = self.cache.get(url, accept, identity)
+            if cached is not None:
+                if self.cache.is_fresh(cached):
+                    L.debug("Cache hit: %s", url)
+                    self.stats.add("cached")
+                    return cached.content, Headers(cached.headers)
+                if cached.etag:
+                    headers["If-None-Match"] = cached.etag
+                if cached.last_modified:
+                    headers["If-Modified-Since"] = cached.last_modified
+        try:
+            status, recv_headers, content = self._send_with_retry(verb, url, headers, data)
+        finally:
+            if verb not in ("GET", "HEAD", "OPTIONS") and self.cache is not None:
+                self.cache.invalidate(url, identity)  # also on errors, the write may have been applied
+        if status == 304 and cached is not None and self.cache is not None:
+            L.debug("Not modified: %s", url)
+            self.stats.add("not_modified")
+            recv_headers = Headers({**cached.headers, **recv_headers})
+            self.cache.put(url, accept, recv_headers, cached.content, identity)
+            return cached.content, recv_headers
+        if verb == "GET" and self.cache is not None:
+            self.cache.put(url, accept, recv_headers, content, identity)
+        return content, recv_headers
+
+    def _send_with_retry(self, verb: str, url: str, headers: dict[str, str], data: T.Optional[bytes]):
+        """Send a request, retry on rate limit, server errors and connection errors"""
+        attempt = 0
+        while True:
+            self._throttle(_resource(url))
+            self.stats.add("requests")
+            try:
+                status, recv_headers, content = self._send(verb, url, headers, data)
+            except urllib.error.HTTPError as e:
+                recv_headers = Headers(e.headers or {})
+                self._update_rate_limit(recv_headers)
+                wait = self._retry_wait(verb, e.code, recv_headers, attempt)
+                if wait is None:
+                    raise
+                L.warning("%s %s failed with %d, retry after %.1fs", verb, url, e.code, wait)
+            except (urllib.error.URLError, ConnectionError, TimeoutError) as e:
+                if verb not in IDEMPOTENT_VERBS or attempt >= self.retry.max_retries:
+                    raise
+                wait = self.retry.backoff_seconds(attempt)
+                L.warning("%s %s failed with %s, retry after %.1fs", verb, url, e, wait)
+            else:
+                self._update_rate_limit(recv_headers)
+                return status, recv_headers, content
+            self.stats.add("retries")
+            if self.retry.sleep:
+                time.sleep(wait)
+            attempt += 1
+
+    def _retry_wait(self, verb: str, code: int, headers: Headers, attempt: int) -> T.Optional[float]:
+        """Seconds to wait before retry, or None if the request must not be retried"""
+        if attempt >= self.retry.max_retries:
+            return None
+        if code == 429 or (code == 403 and ("Retry-After" in headers or headers.get("X-RateLimit-Remaining") == "0")):
+            # rate limited requests are not processed, so any verb can be retried
+            if "Retry-After" in headers:
+                wait = float(headers["Retry-After"])
+            elif "X-RateLimit-Reset" in headers:
+                wait = max(0.0, float(headers["X-RateLimit-Reset"]) - time.time()) + 1
+            else:
+                wait = 60.0
+            return wait if wait <= self.retry.max_wait else None
+        if code in RETRY_STATUS and verb in IDEMPOTENT_VERBS:
+            return self.retry.backoff_seconds(attempt)
+        return None
+
+    def _update_rate_limit(self, headers: Headers):
+        values = {
+            k.lower(): int(headers[f"X-RateLimit-{k}"])
+            for k in ("Remaining", "Limit", "Reset")
+            if f"X-RateLimit-{k}" in headers
+        }
+        if values:
+            with self._rate_lock:
+                self.rate_limit.setdefault(headers.get("X-RateLimit-Resource", "core"), {}).update(values)
+
+    def _throttle(self, resource: str):
+        """Spread remaining requests until the reset time when the budget of the resource is low"""
+        with self._rate_lock:
+            budget = self.rate_limit.get(resource, {})
+            remaining, limit, reset = (budget.get(x) for x in ("remaining", "limit", "reset"))
+        if remaining is None or not limit or reset is None or remaining >= limit * self.retry.throttle_ratio:
+            return
+        wait = min(self.retry.max_throttle, max(0.0, reset - time.time()) / max(remaining, 1))
+        if wait > 0:
+            L.verbose1("Rate limit remaining %d/%d, wait %.1fs", remaining, limit, wait)
+            self.stats.add("throttled", wait)
+            time.sleep(wait)
+
+    def _send(self, verb: str, url: str, headers: dict[str, str], data: T.Optional[bytes]):
+        """Send a request and return (status, headers, content). Raise HTTPError for error status"""
+        L.debug("%s %s", verb, url)
+        if self.cassette is not None:
+            status, recv_headers, content = self.cassette.send(
+                verb, url, data, lambda: self._send_http(verb, url, headers, data)
+            )
+            return status, Headers(recv_headers), content
+        return self._send_http(verb, url, headers, data)
+
+    def _send_http(self, verb: str, url: str, headers: dict[str, str], data: T.Optional[bytes]):
+        headers = {"User-Agent": USER_AGENT, **headers}
+        if self._use_proxy(url):
+            return self._send_urllib(verb, url, headers, data)
+        for _ in range(5):
+            resp, content = self.pool.request(verb, url, headers, data)
+            location = resp.getheader("Location")
+            if resp.status not in REDIRECT_STATUS or not location:
+                break
+            next_url = urllib.parse.urljoin(url, location)
+            if urllib.parse.urlsplit(next_url).netloc != urllib.parse.urlsplit(url).netloc:
+                headers = {k: v for k, v in headers.items() if k.lower() != "authorization"}
+            if resp.status == 303 or (resp.status in (301, 302) and verb not in ("GET", "HEAD")):
+                verb, data = "GET", None
+            L.debug("Redirect to %s", next_url)
+            url = next_url
+        if resp.status >= 400:
+            raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, io.BytesIO(content))
+        return resp.status, Headers(resp.headers), content
+
+    def _use_proxy(self, url: str) -> bool:
+        """http.client does not support proxies, use urllib instead if proxy is configured"""
+        parts = urllib.parse.urlsplit(url)
+        return parts.scheme in urllib.request.getproxies() and not urllib.request.proxy_bypass(parts.hostname or "")
+
+    def _send_urllib(self, verb: str, url: str, headers: dict[str, str], data: T.Optional[bytes]):
+        req = urllib.request.Request(url, data=data, headers=headers, method=verb)
+        try:
+            with urllib.request.urlopen(req) as resp:
+                return resp.status, Headers(resp.headers), resp.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return e.code, Headers(e.headers), b""
+            raise
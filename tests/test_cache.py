@@ -0,0 +1,32 @@
+import concurrent.futures
+import threading
+
+from dandori.cache import DirectoryCache
+
+
+def test_get_builds_once(tmp_path):
+    cache = DirectoryCache(tmp_path)
+    built = []
+
+    def build(path):
+        built.append(path)
+        path.joinpath("file").write_text("x")
+
+    with concurrent.futures.ThreadPoolExecutor(4) as pool:
+        entries = list(pool.map(lambda _: cache.get("org/repo/sha", build), range(8)))
+    assert len(built) == 1
+    assert all(x.joinpath("file").read_text() == "x" for x in entries)
+
+
+def test_get_builds_different_keys_concurrently(tmp_path):
+    cache = DirectoryCache(tmp_path)
+    barrier = threading.Barrier(2, timeout=10)
+
+    def build(path):
+        barrier.wait()  # broken if builds of different keys are serialized
+        path.joinpath("file").write_text(path.name)
+
+    with concurrent.futures.ThreadPoolExecutor(2) as pool:
+        entries = list(pool.map(lambda key: cache.get(key, build), ["org/a/sha", "org/b/sha"]))
+    assert [x.joinpath("file").read_text() for x in entries] == ["sha", "sha"]
+    assert not barrier.broken
@@ -0,0 +1,92 @@
+import types
+
+import pytest
+
+from dandori import checks
+
+
+class FakeChecksApi:
+    def __init__(self):
+        self.requests = []
+        self.checks = types.SimpleNamespace(create=self._create, update=self._update)
+
+    def _create(self, **kwargs):
+        self.requests.append(("create", kwargs))
+        return types.SimpleNamespace(id=1)
+
+    def _update(self, **kwargs):
+        self.requests.append(("update", kwargs))
+
+
+def _annotations(request) -> int:
+    return len(request[1].get("output", {}).get("annotations", []))
+
+
+def test_annotations_are_batched():
+    api = FakeChecksApi()
+    run = checks.CheckRun(api, "lint", "s" * 40, min_interval=3600)
+    run.start()
+    for i in range(120):
+        run.annotate("a.py", i + 1, "message")
+    assert [x[0] for x in api.requests] == ["create"]
+    run.finish("failure")
+    assert [(x[0], _annotations(x)) for x in api.requests] == [
+        ("create", 0),
+        ("update", 50),
+        ("update", 50),
+        ("update", 20),
+    ]
+    assert api.requests[-1][1]["conclusion"] == "failure"
+    assert "conclusion" not in api.requests[1][1]
+
+
+def test_deferred_check_is_created_completed():
+    api = FakeChecksApi()
+    run = checks.CheckRun(api, "lint", "s" * 40, defer=3600)
+    run.start()
+    run.annotate("a.py", 1, "message")
+    run.set_output(summary="done")
+    assert api.requests == []
+    run.finish("success")
+    assert len(api.requests) == 1
+    kind, kwargs = api.requests[0]
+    assert kind == "create"
+    assert kwargs["status"] == "completed"
+    assert kwargs["conclusion"] == "success"
+    assert kwargs["output"]["summary"] == "done"
+    assert _annotations(api.requests[0]) == 1
+
+
+def test_empty_output_is_omitted():
+    api = FakeChecksApi()
+    run = checks.CheckRun(api, "lint", "s" * 40)
+    run.start()
+    run.finish("success")
+    assert [x[1] for x in api.requests] == [
+        {"name": "lint", "head_sha": "s" * 40, "status": "in_progress"},
+        {"check_run_id": 1, "name": "lint", "status": "completed", "conclusion": "success"},
+    ]
+
+
+def test_umbrella_reports_to_summary():
+    api = FakeChecksApi()
+    run = checks.CheckRun(api, "all", "s" * 40, defer=3600)
+    umbrella = checks.Umbrella(run)
+    run.start()
+    sub = checks.SubCheck(run, "lint")
+    sub.annotate("a.py", 1, "message")
+    umbrella.report("lint", "failure")
+    umbrella.report("test", "success")
+    run.finish(umbrella.conclusion)
+    assert len(api.requests) == 1
+    kwargs = api.requests[0][1]
+    assert kwargs["conclusion"] == "failure"
+    assert kwargs["output"]["summary"] == "- lint: failure\n- test: success"
+    assert kwargs["output"]["annotations"][0]["title"] == "lint"
+
+
+def test_annotation_level():
+    with pytest.raises(ValueError):
+        checks.annotation("a.py", 1, "message", level="error")
+    assert checks.worse("success", "failure") == "failure"
+    assert checks.worse(None, "neutral") == "neutral"
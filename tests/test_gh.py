@@ -0,0 +1,126 @@
+import types
+
+import pytest
+
+import dandori.checkout
+from dandori.gh import GitHub
+
+ENVIRON = {
+    "GITHUB_REPOSITORY": "owner/repo",
+    "GITHUB_EVENT_NAME": "pull_request",
+    "GITHUB_SHA": "0" * 40,
+    "GITHUB_REF": "refs/pull/1/merge",
+    "GITHUB_WORKFLOW": "ci",
+    "GITHUB_ACTION": "run",
+    "GITHUB_ACTOR": "user",
+    "GITHUB_JOB": "job",
+    "GITHUB_RUN_NUMBER": "1",
+    "GITHUB_RUN_ID": "1",
+}
+
+GRAPHQL_PULL_REQUEST = {
+    "number": 1,
+    "title": "title",
+    "body": "",
+    "state": "OPEN",
+    "merged": False,
+    "isDraft": False,
+    "mergeable": "MERGEABLE",
+    "url": "https://github.com/owner/repo/pull/1",
+    "author": {"login": "user"},
+    "mergeCommit": None,
+    "potentialMergeCommit": {"oid": "m" * 40},
+    "headRefName": "topic",
+    "headRefOid": "h" * 40,
+    "baseRefName": "main",
+    "baseRefOid": "b" * 40,
+    "headRepository": {"nameWithOwner": "owner/repo"},
+    "baseRepository": {"nameWithOwner": "owner/repo"},
+    "labels": {"nodes": [{"name": "bug", "color": "red"}]},
+    "commits": {"nodes": []},
+}
+
+
+class FakeApi:
+    def __init__(self):
+        self.requests = []
+        self.pulls = types.SimpleNamespace(get=self._get_pull)
+
+    def __call__(self, path, verb=None, headers=None, route=None, query=None, data=None):
+        self.requests.append(path)
+        refs = {"totalCount": 1, "nodes": [{"name": "v1.0.0"}]}
+        repository = {"pullRequest": GRAPHQL_PULL_REQUEST, "refs": refs, "latestRelease": {"tagName": "v1.0.0"}}
+        return {"data": {"repository": repository}}
+
+    def _get_pull(self, number):
+        self.requests.append(f"pulls/{number}")
+        return {"number": number, "changed_files": 3, "head": {"sha": "h" * 40}}
+
+
+@pytest.fixture
+def gh():
+    return GitHub(environ=ENVIRON, payload={"pull_request": {"number": 1}}, api=FakeApi(), checkout=False)
+
+
+def test_pull_request_is_rest_response(gh):
+    assert gh.pull_request().changed_files == 3
+    assert gh.api.requests == ["pulls/1"]
+
+
+def test_pull_request_summary_from_snapshot(gh):
+    pr = gh.pull_request_summary()
+    assert pr.head.sha == "h" * 40
+    assert pr.merge_commit_sha == "m" * 40
+    assert gh.has_label("bug")
+    assert gh.has_tag("v1.0.0")
+    assert not gh.has_tag("v2.0.0")
+    assert gh.api.requests == ["/graphql"]
+
+
+def test_checkout_pull_request_applies_depth_to_strategy(gh, monkeypatch, tmp_path):
+    checkouts = []
+    monkeypatch.setattr(dandori.checkout, "checkout", lambda oper, ref, strategy: checkouts.append((ref, strategy)))
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / ".git").mkdir()
+    gh.checkout_pull_request(dandori.checkout.Strategy("shallow"), depth=5)
+    gh.checkout_pull_request(dandori.checkout.Strategy("sparse", paths=("src",)), paths=["docs"])
+    assert checkouts == [
+        ("m" * 40, dandori.checkout.Strategy("shallow", depth=5)),
+        ("m" * 40, dandori.checkout.Strategy("sparse", paths=("docs",))),
+    ]
+
+
+class FakePages:
+    def __init__(self, total: int):
+        self.total = total
+        self.calls = []
+
+    def __call__(self, number, per_page, page):
+        self.calls.append((per_page, page))
+        start = (page - 1) * per_page
+        return {"items": [{"id": i} for i in range(start, min(start + per_page, self.total))]}
+
+
+@pytest.mark.parametrize("prefetch", [True, False])
+def test_iter_pages_clamps_per_page(gh, prefetch):
+    oper = FakePages(250)
+    items = list(gh.iter_pages(oper, 1, key="items", per_page=500, prefetch=prefetch))
+    assert [x.id for x in items] == list(range(250))
+    assert oper.calls == [(100, 1), (100, 2), (100, 3)]
+
+
+def test_iter_pages_stops_early(gh):
+    oper = FakePages(1000)
+    pages = gh.iter_pages(oper, 1, key="items", per_page=10, prefetch=False)
+    assert [next(pages).id for _ in range(15)] == list(range(15))
+    pages.close()
+    assert oper.calls == [(10, 1), (10, 2)]
+
+
+def test_iter_pages_prefetches_one_page(gh):
+    oper = FakePages(1000)
+    pages = gh.iter_pages(oper, 1, key="items", per_page=10)
+    assert next(pages).id == 0
+    pages.close()
+    assert oper.calls[0] == (10, 1)
+    assert len(oper.calls) <= 2  # the next page at most
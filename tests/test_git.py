@@ -0,0 +1,27 @@
+import subprocess as sp
+
+import pytest
+
+from dandori import git
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "https://github.com/owner/repo.git",
+        "https://github.com/owner/repo",
+        "git@github.com:owner/repo.git",
+        "ssh://git@github.com/owner/repo.git",
+    ],
+)
+def test_remote_repository(tmp_path, url):
+    sp.run(["git", "init", "-q"], cwd=tmp_path, check=True)
+    sp.run(["git", "remote", "add", "origin", url], cwd=tmp_path, check=True)
+    assert git.remote_repository("origin", cwd=str(tmp_path)) == "owner/repo"
+
+
+def test_remote_repository_other_host(tmp_path):
+    sp.run(["git", "init", "-q"], cwd=tmp_path, check=True)
+    sp.run(["git", "remote", "add", "origin", "https://example.com/owner/repo.git"], cwd=tmp_path, check=True)
+    assert git.remote_repository("origin", cwd=str(tmp_path)) is None
+    assert git.remote_repository("upstream", cwd=str(tmp_path)) is None
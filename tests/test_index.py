@@ -0,0 +1,85 @@
+import pathlib
+
+import pytest
+
+from dandori import config, index, run
+
+
+@pytest.fixture(autouse=True)
+def cachedir(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_DIR", str(tmp_path.joinpath("cache")))
+    monkeypatch.delenv("DANDORI_HANDLER_INDEX", raising=False)
+
+
+def _write(path: pathlib.Path, code: str) -> pathlib.Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(code)
+    return path
+
+
+def _handler(path: pathlib.Path) -> config.Handler:
+    return config.Handler(config.LocalHandlerLoader(path.stem, path))
+
+
+def test_function_names_of_module(tmp_path):
+    source = _write(
+        tmp_path / "handler.py",
+        "import os\nfrom x import y as z\nA = 1\ntry:\n    def pull_request(ctx): ...\nexcept ImportError:\n    pass\n",
+    )
+    assert index.function_names(source) == {"os", "z", "A", "pull_request"}
+
+
+def test_function_names_of_package_with_relative_star(tmp_path):
+    _write(tmp_path / "pkg" / "__init__.py", "from .events import *\n")
+    _write(tmp_path / "pkg" / "events.py", "def push(ctx): ...\ndef _private(): ...\n")
+    assert index.function_names(tmp_path / "pkg") == {"push"}
+
+
+def test_function_names_respects_all(tmp_path):
+    _write(tmp_path / "pkg" / "__init__.py", "from .events import *\n")
+    _write(tmp_path / "pkg" / "events.py", "__all__ = ['push']\ndef push(ctx): ...\ndef issues(ctx): ...\n")
+    assert index.function_names(tmp_path / "pkg") == {"push"}
+
+
+@pytest.mark.parametrize(
+    "code",
+    [
+        "def __getattr__(name): ...\n",
+        "from os.path import *\n",
+        "globals()['push'] = print\n",
+        "from .missing import *\n",
+        "def broken(:\n",
+    ],
+)
+def test_function_names_undecidable(tmp_path, code):
+    assert index.function_names(_write(tmp_path / "handler.py", code)) is None
+
+
+def test_function_names_missing_source(tmp_path):
+    assert index.function_names(tmp_path / "missing") is None
+
+
+def test_summary_is_cached(tmp_path):
+    source = _write(tmp_path / "handler.py", "def push(ctx): ...\n")
+    assert index.function_names(source) == {"push"}
+    assert len(list(tmp_path.joinpath("cache", "dandori", "index").glob("*/*.json"))) == 1
+    source.write_text("def issues(ctx): ...\n")
+    assert index.function_names(source) == {"issues"}
+
+
+def test_may_define(tmp_path):
+    handler = _handler(_write(tmp_path / "handler.py", "def push(ctx): ...\n"))
+    assert handler.may_define("push")
+    assert not handler.may_define("pull_request")
+    dynamic = _handler(_write(tmp_path / "dynamic.py", "exec('def pull_request(ctx): ...')\n"))
+    assert dynamic.may_define("pull_request")
+    assert _handler(tmp_path / "missing.py").may_define("pull_request")  # deploy reports the error
+
+
+def test_select_handlers_skips_without_function(tmp_path, monkeypatch):
+    push = _handler(_write(tmp_path / "a.py", "def push(ctx): ...\n"))
+    issues = _handler(_write(tmp_path / "b.py", "def issues(ctx): ...\n"))
+    runner = run.Runner(None, None)
+    assert runner._select_handlers([push, issues], "push", 2) == [push]
+    monkeypatch.setenv("DANDORI_HANDLER_INDEX", "0")
+    assert runner._select_handlers([push, issues], "push", 2) == [push, issues]
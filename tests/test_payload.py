@@ -0,0 +1,25 @@
+import json
+
+from dandori.payload import Payload, PayloadList
+
+
+def test_payload_access():
+    payload = Payload({"issue": {"number": 1, "labels": [{"name": "bug"}]}})
+    assert isinstance(payload, dict)
+    assert payload.issue.number == 1
+    assert payload["issue"]["labels"][0].name == "bug"
+    assert isinstance(payload.get("issue"), Payload)
+    assert isinstance(payload.issue.labels, PayloadList)
+    assert [x.name for x in payload.issue.labels] == ["bug"]
+    assert payload.get("comment", {}).get("body", "") == ""
+
+
+def test_payload_dict_compatibility():
+    data = {"issue": {"number": 1, "labels": [{"name": "bug"}]}}
+    payload = Payload(data)
+    payload.issue.labels[0].name  # wrap nested values
+    assert json.loads(json.dumps(payload)) == data
+    payload["action"] = "opened"
+    payload.issue["number"] = 2
+    assert payload["action"] == "opened"
+    assert payload.issue.number == 2
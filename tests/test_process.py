@@ -0,0 +1,104 @@
+import asyncio
+import concurrent.futures
+import os
+import subprocess as sp
+import sys
+import time
+
+import pytest
+
+from dandori import process
+from dandori.ops import Operation
+
+TIMEOUT = 10
+
+
+def _raise():
+    raise ValueError("boom")
+
+
+def _run(coro):
+    return process._run_until_complete(asyncio.wait_for(coro, TIMEOUT))
+
+
+def test_in_thread_result():
+    async def main():
+        return await process._in_thread(lambda x: x * 2, 21)
+
+    assert _run(main()) == 42
+
+
+def test_in_thread_exception():
+    async def main():
+        return await asyncio.gather(*(process._in_thread(_raise) for _ in range(20)), return_exceptions=True)
+
+    errors = _run(main())
+    assert len(errors) == 20
+    assert all(isinstance(x, ValueError) for x in errors)
+
+
+def test_run_usage():
+    result = process.run([sys.executable, "-c", "print('hello'); raise SystemExit(3)"], echo=False)
+    assert result.returncode == 3
+    assert result.stdout == "hello\n"
+    assert result.usage.wall > 0
+
+
+def test_run_wait_error(monkeypatch):
+    def wait4(pid, options):
+        raise ChildProcessError("no child")
+
+    monkeypatch.setattr(os, "wait4", wait4, raising=False)
+    with pytest.raises(ChildProcessError):
+        _run(process.arun([sys.executable, "-c", "pass"], echo=False))
+
+
+def test_run_stdin_error(monkeypatch):
+    def feed_stdin(stdin, ipt):
+        stdin.close()
+        raise OSError("cannot write")
+
+    monkeypatch.setattr(process, "_feed_stdin", feed_stdin)
+    with pytest.raises(OSError, match="cannot write"):
+        _run(process.arun([sys.executable, "-c", "import sys; sys.stdin.read()"], echo=False, input="x"))
+
+
+def test_run_check():
+    with pytest.raises(sp.CalledProcessError):
+        process.run([sys.executable, "-c", "raise SystemExit(1)"], echo=False, check=True)
+
+
+def test_run_many():
+    results = process.run_many([[sys.executable, "-c", f"print({i})"] for i in range(3)], echo=False)
+    assert [x.stdout for x in results] == ["0\n", "1\n", "2\n"]
+
+
+def test_run_many_cancel_on_failure():
+    commands = [[sys.executable, "-c", "import time; time.sleep(30)"], [sys.executable, "-c", "raise SystemExit(2)"]]
+    with pytest.raises(sp.CalledProcessError) as e:
+        _run(process.arun_many(commands, max_parallel=2, echo=False, check=True))
+    assert e.value.returncode == 2
+
+
+def test_ops_run_many_cancel_on_failure():
+    commands = [[sys.executable, "-c", "raise SystemExit(3)"], [sys.executable, "-c", "import time; time.sleep(30)"]]
+    started = time.monotonic()
+    with pytest.raises(sp.CalledProcessError) as e:
+        Operation().run_many(commands, max_parallel=2)
+    assert e.value.returncode == 3
+    assert time.monotonic() - started < TIMEOUT
+
+
+def test_run_in_threads_closes_loops(monkeypatch):
+    loops = []
+    new_event_loop = asyncio.new_event_loop
+
+    def track():
+        loops.append(new_event_loop())
+        return loops[-1]
+
+    monkeypatch.setattr(asyncio, "new_event_loop", track)
+    with concurrent.futures.ThreadPoolExecutor(4) as pool:
+        list(pool.map(lambda _: process.run([sys.executable, "-c", "pass"], echo=False), range(8)))
+    assert len(loops) == 8
+    assert all(x.is_closed() for x in loops)
@@ -0,0 +1,81 @@
+import concurrent.futures
+import hashlib
+import hmac
+import http.client
+import json
+import threading
+
+import pytest
+
+from dandori import serve
+
+SECRET = "s3cret"
+
+
+class _Events:
+    pending = 0
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, environ, payload, invoke_function=None):
+        self.submitted.append((environ, payload, invoke_function))
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        future.set_result([])
+        return len(self.submitted), future
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setenv("DANDORI_WEBHOOK_SECRET", SECRET)
+    srv = serve._TCPServer(("127.0.0.1", 0), serve._RequestHandler)
+    srv.events = _Events()
+    thread = threading.Thread(target=srv.serve_forever, args=(0.01,), daemon=True)
+    thread.start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+def _post(srv, body: bytes, headers: dict):
+    conn = http.client.HTTPConnection(*srv.server_address, timeout=10)
+    try:
+        conn.request("POST", "/events", body=body, headers=headers)
+        resp = conn.getresponse()
+        return resp.status, json.loads(resp.read())
+    finally:
+        conn.close()
+
+
+def _sign(body: bytes, secret: str = SECRET) -> str:
+    return "sha256=" + hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+
+
+def test_post_signed(server):
+    body = json.dumps({"environ": {}, "payload": {}, "invoke": "cmd_release"}).encode("utf-8")
+    status, data = _post(server, body, {"Content-Type": "application/json", "X-Hub-Signature-256": _sign(body)})
+    assert status == 202
+    assert data == {"id": 1}
+    assert server.events.submitted[0][2] == "cmd_release"
+
+
+@pytest.mark.parametrize(
+    "headers, status",
+    [
+        ({"Content-Type": "text/plain"}, 415),
+        ({"Content-Type": "application/json"}, 401),
+        ({"Content-Type": "application/json", "X-Hub-Signature-256": "sha256=00"}, 401),
+    ],
+)
+def test_post_rejected(server, headers, status):
+    body = b'{"invoke": "cmd_release"}'
+    if "X-Hub-Signature-256" not in headers and headers["Content-Type"] == "text/plain":
+        headers = {**headers, "X-Hub-Signature-256": _sign(body)}
+    assert _post(server, body, headers)[0] == status
+    assert not server.events.submitted
+
+
+def test_serve_requires_secret_on_tcp(monkeypatch):
+    monkeypatch.delenv("DANDORI_WEBHOOK_SECRET", raising=False)
+    with pytest.raises(serve.exception.DandoriError):
+        serve.serve(runner=None, port=0)
@@ -0,0 +1,212 @@
+import http.server
+import json
+import threading
+import time
+
+import pytest
+
+from dandori import transport
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "_Server"
+
+    def do_GET(self):  # noqa: N802
+        """Reply the next scripted response of the path"""
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.server.requests.append((self.path, dict(self.headers), self.client_address[1]))
+        responses = self.server.responses.get(self.path) or [(200, {}, {})]
+        status, headers, body = responses.pop(0) if len(responses) > 1 else responses[0]
+        content = json.dumps(body).encode("utf-8") if status != 304 else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_POST = do_GET
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Quiet"""
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.requests: list = []
+        self.responses: dict[str, list] = {}
+
+
+@pytest.fixture
+def server(monkeypatch):
+    for name in ("http_proxy", "HTTP_PROXY", "all_proxy", "ALL_PROXY"):
+        monkeypatch.delenv(name, raising=False)
+    srv = _Server()
+    threading.Thread(target=srv.serve_forever, args=(0.01,), daemon=True).start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+def _client(server, tmp_path=None, **kwargs):
+    host, port = server.server_address
+    cache = transport.ResponseCache(tmp_path) if tmp_path is not None else None
+    return transport.Client(owner="o", repo="r", token="t", gh_host=f"http://{host}:{port}", cache=cache, **kwargs)
+
+
+def test_etag_revalidation(server, tmp_path):
+    server.responses["/repos/o/r/issues"] = [(200, {"ETag": '"v1"'}, [{"number": 1}]), (304, {"ETag": '"v1"'}, None)]
+    api = _client(server, tmp_path)
+    assert api("/repos/o/r/issues") == [{"number": 1}]
+    assert api("/repos/o/r/issues") == [{"number": 1}]
+    assert server.requests[1][1]["If-None-Match"] == '"v1"'
+    assert api.stats.get(None) == {"requests": 2, "not_modified": 1}
+
+
+def test_ttl_response_is_not_revalidated(server, tmp_path):
+    server.responses["/repos/o/r/releases/latest"] = [(200, {}, {"tag_name": "v1"})]
+    api = _client(server, tmp_path)
+    assert api("/repos/o/r/releases/latest")["tag_name"] == "v1"
+    assert api("/repos/o/r/releases/latest")["tag_name"] == "v1"
+    assert len(server.requests) == 1
+    assert api.stats.get(None) == {"requests": 1, "cached": 1}
+
+
+def test_retry_server_error(server):
+    server.responses["/repos/o/r"] = [(503, {}, {}), (502, {}, {}), (200, {}, {"id": 1})]
+    api = _client(server, retry=transport.RetryPolicy(backoff=0.01))
+    assert api("/repos/o/r") == {"id": 1}
+    assert api.stats.get(None) == {"requests": 3, "retries": 2}
+
+
+def test_retry_gives_up(server):
+    server.responses["/repos/o/r"] = [(503, {}, {})]
+    api = _client(server, retry=transport.RetryPolicy(max_retries=1, backoff=0.01))
+    with pytest.raises(transport.urllib.error.HTTPError):
+        api("/repos/o/r")
+    assert len(server.requests) == 2
+
+
+def test_no_retry_of_post(server):
+    server.responses["/repos/o/r/issues"] = [(503, {}, {}), (201, {}, {"number": 1})]
+    api = _client(server, retry=transport.RetryPolicy(backoff=0.01))
+    with pytest.raises(transport.urllib.error.HTTPError):
+        api("/repos/o/r/issues", "POST", data={"title": "x"})
+    assert len(server.requests) == 1
+
+
+def _budget(resource: str, remaining: int) -> dict:
+    reset = str(int(time.time()) + 60)
+    return {
+        "X-RateLimit-Resource": resource,
+        "X-RateLimit-Remaining": str(remaining),
+        "X-RateLimit-Limit": "5000",
+        "X-RateLimit-Reset": reset,
+    }
+
+
+def test_throttle_per_resource(server):
+    server.responses["/repos/o/r"] = [(200, _budget("core", 4000), {})]
+    server.responses["/graphql"] = [(200, _budget("graphql", 1), {"data": {}})]
+    api = _client(server, retry=transport.RetryPolicy(max_throttle=0.05))
+    api("/repos/o/r")
+    api("/graphql", "POST", data={"query": "{}"})
+    api("/repos/o/r")  # core budget is enough, not slowed down by the graphql budget
+    assert "throttled" not in api.stats.get(None)
+    assert api.rate_limit["graphql"]["remaining"] == 1
+    assert api.rate_limit["core"]["remaining"] == 4000
+    api("/graphql", "POST", data={"query": "{}"})
+    assert api.stats.get(None)["throttled"] == pytest.approx(0.05)
+
+
+def test_connection_reuse(server):
+    api = _client(server)
+    api("/repos/o/r")
+    api("/repos/o/r")
+    ports = {port for _, _, port in server.requests}
+    assert len(ports) == 1
+
+
+def test_reconnect_after_close(server):
+    server.responses["/repos/o/r"] = [(200, {"Connection": "close"}, {})]
+    api = _client(server)
+    api("/repos/o/r")
+    api("/repos/o/r")
+    ports = {port for _, _, port in server.requests}
+    assert len(ports) == 2
+
+
+def test_debug_hook(server):
+    requests = []
+    api = _client(server, debug=requests.append)
+    api("/repos/o/r")
+    assert [x.full_url for x in requests] == [api.gh_host + "/repos/o/r"]
+
+
+def test_response_cache_ttl(tmp_path, monkeypatch):
+    cache = transport.ResponseCache(tmp_path)
+    url = "https://api.github.com/repos/o/r/releases/latest"
+    assert cache.ttl(url) == 60
+    assert cache.ttl("https://api.github.com/repos/o/r/labels/bug") == 300
+    assert cache.ttl("https://api.github.com/repos/o/r/issues") == 0
+    now = time.time()
+    monkeypatch.setattr(transport.time, "time", lambda: now)
+    cache.put(url, "application/json", transport.Headers(), b"{}")
+    resp = cache.get(url, "application/json")
+    assert resp is not None and resp.content == b"{}"
+    assert cache.is_fresh(resp)
+    monkeypatch.setattr(transport.time, "time", lambda: now + 61)
+    assert not cache.is_fresh(resp)
+
+
+def test_response_cache_keys(tmp_path):
+    cache = transport.ResponseCache(tmp_path)
+    url = "https://api.github.com/repos/o/r/issues"
+    cache.put(url, "application/json", transport.Headers(), b"[]")  # neither validator nor TTL
+    assert cache.get(url, "application/json") is None
+    cache.put(url, "application/json", transport.Headers({"ETag": '"v1"'}), b"[]", identity="a")
+    assert cache.get(url, "application/json", identity="a").headers["etag"] == '"v1"'
+    assert cache.get(url, "application/json", identity="b") is None
+    assert cache.get(url, "text/plain", identity="a") is None
+
+
+def test_response_cache_invalidate(tmp_path):
+    cache = transport.ResponseCache(tmp_path)
+    latest = "https://api.github.com/repos/o/r/releases/latest"
+    label = "https://api.github.com/repos/o/r/labels/bug"
+    for url in (latest, label):
+        cache.put(url, "application/json", transport.Headers(), b"{}")
+    cache.invalidate("https://api.github.com/repos/o/r/releases/1")
+    assert cache.get(latest, "application/json") is None
+    assert cache.get(label, "application/json") is not None
+    cache.invalidate("https://api.github.com/repos/o/r/labels/bug")
+    assert cache.get(label, "application/json") is None
+
+
+def test_response_cache_evicts_least_recently_used(tmp_path):
+    cache = transport.ResponseCache(tmp_path)
+    urls = [f"https://api.github.com/repos/o/r/labels/{x}" for x in ("a", "b", "c")]
+    for i, url in enumerate(urls):
+        cache.put(url, "application/json", transport.Headers(), b"x" * 100)
+        transport.os.utime(cache._path(url, "application/json", ""), (i + 1, i + 1))  # older files first
+    assert cache.get(urls[0], "application/json") is not None  # used recently
+    size = sum(p.stat().st_size for p in tmp_path.rglob("*") if p.is_file())
+    transport.dandori.cache.prune_files(tmp_path, size * 2 // 3)
+    assert cache.get(urls[0], "application/json") is not None
+    assert cache.get(urls[1], "application/json") is None
+    assert cache.get(urls[2], "application/json") is not None
+
+
+def test_response_cache_size_cap_on_put(tmp_path):
+    tmp_path.joinpath("old").write_bytes(b"x" * 1000)
+    transport.os.utime(tmp_path.joinpath("old"), (1, 1))
+    cache = transport.ResponseCache(tmp_path, max_bytes=500)
+    url = "https://api.github.com/repos/o/r/labels/a"
+    cache.put(url, "application/json", transport.Headers(), b"{}")
+    assert not tmp_path.joinpath("old").exists()
+    assert cache.get(url, "application/json") is not None